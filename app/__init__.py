@@ -15,6 +15,10 @@ def create_app(config_name):
     db.init_app(app)
     redis_store.init_app(app)
 
+    from .units.loader import reset_entities, log_entity_stats
+    app.before_request(reset_entities)
+    app.after_request(log_entity_stats)
+
     from .main import main as main_blueprint
     app.register_blueprint(main_blueprint)
 
@@ -2,6 +2,9 @@ from flask_restful import Resource, abort
 from flask_httpauth import HTTPBasicAuth
 from flask import g
 from ..models import Admin
+from ..units.principals import principal_cache
+from ..units import refresh_tokens, captcha_pool
+from ..units.wxclient import wx_client
 from . import admin_api_bp, admin_api
 
 auth = HTTPBasicAuth()
@@ -10,10 +13,12 @@ auth = HTTPBasicAuth()
 @auth.verify_password
 def verify_password(username_or_token, password):
     admin_user = Admin.verify_auth_token(username_or_token)
+    g.password_auth = False
     if not admin_user:
         admin_user = Admin.query.filter_by(name=username_or_token).first()
         if not admin_user or not admin_user.verify_password(password):
             return False
+        g.password_auth = True
     g.admin_user = admin_user
     return True
 
@@ -32,7 +37,40 @@ def auth_error():
 class GetToken(Resource):
     def get(self):
         token = g.admin_user.generate_auth_token(600)
-        return {'code': 1, 'token': token, 'expiration': 600}
+        result = {
+            'code': 1,
+            'token': token,
+            'expiration': 600
+        }
+        # 只有用密码登录时才发刷新 token，访问 token 不能用来续出新的会话
+        if g.password_auth:
+            result['refresh_token'] = refresh_tokens.issue('admin', g.admin_user.id)
+        return result
+
+
+class Sessions(Resource):
+    def delete(self):
+        revoked = refresh_tokens.revoke_all('admin', g.admin_user.id)
+        return {'code': 1, 'revoked': revoked}
+
+
+class AuthCacheStats(Resource):
+    def get(self):
+        return {'code': 1, 'principal_cache': principal_cache().stats()}
+
+
+class CaptchaPoolStats(Resource):
+    def get(self):
+        return {'code': 1, 'captcha_pool': captcha_pool.stats()}
+
+
+class WxClientStats(Resource):
+    def get(self):
+        return {'code': 1, 'wx_client': wx_client().stats()}
 
 
 admin_api.add_resource(GetToken, '/token')
+admin_api.add_resource(Sessions, '/sessions')
+admin_api.add_resource(AuthCacheStats, '/authcache')
+admin_api.add_resource(CaptchaPoolStats, '/captchapool')
+admin_api.add_resource(WxClientStats, '/wxclient')
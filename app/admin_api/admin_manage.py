@@ -5,6 +5,8 @@ from webargs import fields, ValidationError
 from webargs.flaskparser import use_args
 from sqlalchemy.exc import IntegrityError
 from ..models import School, Tcode, Teacher, Course, Student, SchoolStudent
+from ..units.loader import get_entity, forget_entity
+from ..units import membership, quota
 from .. import db
 from . import admin_api
 
@@ -193,18 +195,24 @@ student_info = {
 
 
 def abort_if_school_doesnt_exist(id):
-    if School.query.get(id) is None:
+    entity = get_entity(School, id)
+    if entity is None:
         abort(404, message='学校不存在')
+    return entity
 
 
 def abort_if_teacher_doesnt_exist(id):
-    if Teacher.query.get(id) is None:
+    entity = get_entity(Teacher, id)
+    if entity is None:
         abort(404, message='教师不存在')
+    return entity
 
 
 def abort_if_student_doesnt_exist(id):
-    if Student.query.get(id) is None:
+    entity = get_entity(Student, id)
+    if entity is None:
         abort(404, message='学生不存在')
+    return entity
 
 
 class SchoolList(Resource):
@@ -255,22 +263,21 @@ class SchoolList(Resource):
 class Schoolx(Resource):
     @marshal_with(school_created, envelope='resource')
     def get(self, id):
-        abort_if_school_doesnt_exist(id)
-        school = School.query.get(id)
+        school = abort_if_school_doesnt_exist(id)
         return school, 200
 
     def delete(self, id):
-        abort_if_school_doesnt_exist(id)
-        school = School.query.get(id)
+        school = abort_if_school_doesnt_exist(id)
         db.session.delete(school)
         db.session.commit()
+        forget_entity(School, id)
+        membership.invalidate_school(id)
         return '', 204
 
     @marshal_with(school_created, envelope='resource')
     @use_args(school_args)
     def put(self, args, id):
-        abort_if_school_doesnt_exist(id)
-        school = School.query.get(id)
+        school = abort_if_school_doesnt_exist(id)
         school.name = args['name']
         school.intro = args['intro']
         school.admin = args['admin_phone']
@@ -321,8 +328,8 @@ class TeacherList(Resource):
                 error_out=True
             )
         else:
-            abort_if_school_doesnt_exist(s_id)
-            pagination = School.query.get(s_id).teachers.paginate(
+            school = abort_if_school_doesnt_exist(s_id)
+            pagination = school.teachers.paginate(
                 page=page,
                 per_page=per_page,
                 error_out=True
@@ -347,22 +354,20 @@ class TeacherList(Resource):
 class Teacherx(Resource):
     @marshal_with(teacher_created, envelope='resource')
     def get(self, id):
-        abort_if_teacher_doesnt_exist(id)
-        teacher = Teacher.query.get(id)
+        teacher = abort_if_teacher_doesnt_exist(id)
         return teacher, 200
 
     def delete(self, id):
-        abort_if_teacher_doesnt_exist(id)
-        teacher = Teacher.query.get(id)
+        teacher = abort_if_teacher_doesnt_exist(id)
         db.session.delete(teacher)
         db.session.commit()
+        forget_entity(Teacher, id)
         return '', 204
 
     @marshal_with(teacher_created, envelope='resource')
     @use_args(teacher_args)
     def put(self, args, id):
-        abort_if_teacher_doesnt_exist(id)
-        teacher = Teacher.query.get(id)
+        teacher = abort_if_teacher_doesnt_exist(id)
         teacher.nickname = args['nickname']
         teacher.rename = args['rename']
         teacher.intro = args['intro']
@@ -391,8 +396,7 @@ class DismissTeacher(Resource):
         s_id = args['school_id']
         t_id = args['teacher_id']
         abort_if_school_doesnt_exist(s_id)
-        abort_if_teacher_doesnt_exist(t_id)
-        teacher = Teacher.query.get(t_id)
+        teacher = abort_if_teacher_doesnt_exist(t_id)
         teacher.dismiss_school(s_id)
         return '', 204
 
@@ -409,8 +413,7 @@ class StudentList(Resource):
                 page=page, per_page=per_page, error_out=True
             )
         else:
-            abort_if_school_doesnt_exist(s_id)
-            school = School.query.get(s_id)
+            school = abort_if_school_doesnt_exist(s_id)
             pagination = school.students.paginate(
                 page=page, per_page=per_page, error_out=True
             )
@@ -436,16 +439,14 @@ class ScStudent(Resource):
     @marshal_with(scstudent_info, envelope='resource')
     def get(self, school_id, student_id):
         abort_if_school_doesnt_exist(school_id)
-        abort_if_student_doesnt_exist(student_id)
-        student = Student.query.get(student_id)
+        student = abort_if_student_doesnt_exist(student_id)
         if student.is_school_joined(school_id) is False:
             abort(404, message='该学校没有此学生')
         member_info = SchoolStudent.query.filter_by(
             school_id=school_id,
             student_id=student_id
         ).first()
-        student.vip_times = member_info.vip_times
-        student.nomal_times = member_info.nomal_times
+        student.vip_times, student.nomal_times = quota.times(member_info)
         student.vip_expire = member_info.vip_expire
         student.join_timestamp = member_info.timestamp
         return student, 200
@@ -454,7 +455,7 @@ class ScStudent(Resource):
 class Studentx(Resource):
     @marshal_with(student_info, envelope='resource')
     def get(self, id):
-        student = Student.query.get(id)
+        student = get_entity(Student, id)
         if student is None:
             abort(404, message='没有这个学生')
         return student, 200
@@ -462,7 +463,7 @@ class Studentx(Resource):
     @marshal_with(student_info, envelope='resource')
     @use_args(student_args)
     def put(self, args, id):
-        student = Student.query.get(id)
+        student = get_entity(Student, id)
         if student is None:
             abort(404, message='没有这个学生')
         student.telephone = args['telephone']
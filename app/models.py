@@ -4,9 +4,25 @@ import json
 from datetime import datetime
 from flask import current_app
 from flask_restful import abort
-from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from sqlalchemy.exc import IntegrityError
 from . import db
+from .units.loader import get_entity
+from .units.principals import load_token_user, invalidate_principal
+from .units import credentials, passwords
+from .units.school_config import invalidate_school_config
+
+
+# 将逗号分隔的 img_ids 拆成整数 id 列表，保持原有顺序
+def parse_img_ids(img_ids):
+    ids = []
+    if not img_ids:
+        return ids
+    for i in img_ids.split(','):
+        i = i.strip()
+        if i.isdigit() and int(i) not in ids:
+            ids.append(int(i))
+    return ids
 
 
 class Admin(db.Model):
@@ -21,26 +37,21 @@ class Admin(db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        credentials.forget_password(self)
+        self.password_hash = passwords.hash_password(password)
 
 # 验证密码哈希串
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return credentials.verify_password(self, password)
 
 # 生成token
     def generate_auth_token(self, expiration=600):
         s = Serializer(current_app.config['SECRET_KEY'], expires_in=expiration)
-        return s.dumps({'id': self.id}).decode('utf-8')
+        return s.dumps({'id': self.id, 'role': 'admin'}).decode('utf-8')
 
     @staticmethod
     def verify_auth_token(token):
-        s = Serializer(current_app.config['SECRET_KEY'])
-        try:
-            data = s.loads(token)
-        except:
-            return False
-        admin_user = Admin.query.get(data['id'])
-        return admin_user
+        return load_token_user(Admin, 'admin', token)
 
 
 employs = db.Table(
@@ -87,6 +98,44 @@ class SchoolStudent(db.Model):
         )
     )
 
+    # 会员有效且次数不限(-1)或有剩余，或者普通次数有剩余
+    @staticmethod
+    def can_ask_clause(now):
+        vip_valid = SchoolStudent.vip_expire > now
+        return db.or_(
+            db.and_(vip_valid, db.or_(SchoolStudent.vip_times == -1, SchoolStudent.vip_times > 0)),
+            SchoolStudent.nomal_times > 0
+        )
+
+    @staticmethod
+    def consume_ask(school_id, student_id):
+        """单条条件 UPDATE 扣减一次提问次数，不提交，返回是否扣减成功。
+
+        优先扣会员次数，会员不限次数时不扣，否则扣普通次数。
+        MySQL 按顺序求值 SET，nomal_times 必须先于 vip_times 赋值。
+        """
+        now = datetime.utcnow()
+        vip_valid = SchoolStudent.vip_expire > now
+        table = SchoolStudent.__table__
+        stmt = table.update(preserve_parameter_order=True).where(
+            table.c.school_id == school_id
+        ).where(
+            table.c.student_id == student_id
+        ).where(
+            SchoolStudent.can_ask_clause(now)
+        ).values([
+            (table.c.nomal_times, db.case(
+                [(db.and_(vip_valid, db.or_(table.c.vip_times == -1, table.c.vip_times > 0)),
+                  table.c.nomal_times)],
+                else_=table.c.nomal_times - 1
+            )),
+            (table.c.vip_times, db.case(
+                [(db.and_(vip_valid, table.c.vip_times > 0), table.c.vip_times - 1)],
+                else_=table.c.vip_times
+            ))
+        ])
+        return db.session.execute(stmt).rowcount == 1
+
 
 class School(db.Model):
     __tablename__ = 'schools'
@@ -151,38 +200,40 @@ class Teacher(db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        credentials.forget_password(self)
+        self.password_hash = passwords.hash_password(password)
 
     # 验证密码哈希串
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return credentials.verify_password(self, password)
 
     # 生成token
     def generate_auth_token(self, expiration=600):
         s = Serializer(current_app.config['SECRET_KEY'], expires_in=expiration)
-        return s.dumps({'id': self.id, 'generate_time': json.dumps(datetime.utcnow(), default=lambda d: d.__str__())}).decode('utf-8')
+        from .units import capabilities
+        data = {'id': self.id, 'role': 'teacher', 'generate_time': json.dumps(datetime.utcnow(), default=lambda d: d.__str__())}
+        data.update(capabilities.claims(self, 'teacher'))
+        return s.dumps(data).decode('utf-8')
 
     @staticmethod
     def verify_auth_token(token):
-        s = Serializer(current_app.config['SECRET_KEY'])
-        try:
-            data = s.loads(token)
-        except:
-            return False
-        teacher_user = Teacher.query.get(data['id'])
-        return teacher_user
+        return load_token_user(Teacher, 'teacher', token)
 
     def is_employ(self, school_id):
-        school = School.query.get(school_id)
-        if school is None:
-            return False
-        return school.teachers.filter_by(id=self.id).first() is not None
+        from .units import membership, capabilities
+        if capabilities.has_school(self, school_id):
+            return True
+        return membership.is_teacher(school_id, self.id)
 
     def is_teacher_admin(self, school_id):
-        school = School.query.get(school_id)
+        from .units import capabilities
+        if capabilities.is_school_admin(self, school_id):
+            return True
+        school = get_entity(School, school_id)
         return self.telephone == school.admin and self.is_employ(school_id)
 
     def bind_school(self, tcode):
+        from .units import membership
         school = db.session.query(School).filter(
             School.tcodes.any(Tcode.code == tcode)).first()
         if not school:
@@ -192,16 +243,19 @@ class Teacher(db.Model):
         self.schools.append(school)
         db.session.add(self)
         db.session.commit()
+        membership.invalidate_teachers(school.id)
         code = db.session.query(Tcode).filter_by(code=tcode).first()
         db.session.delete(code)
         db.session.commit()
         return True
 
     def dismiss_school(self, school_id):
-        school = School.query.get(school_id)
+        from .units import membership
+        school = get_entity(School, school_id)
         if self.is_employ(school_id):
             self.schools.remove(school)
             db.session.commit()
+            membership.invalidate_teachers(school_id)
             return True
         abort(401, message='该学校没有这个教师', code=1001)
 
@@ -215,7 +269,7 @@ class Tcode(db.Model):
 
     @staticmethod
     def generate_code(quantity, school_id):
-        school = School.query.get(school_id)
+        school = get_entity(School, school_id)
         if school.tcodes.count() > 0:
             abort(403, message="邀请码使用完才能重新生成", code='2003')
 
@@ -263,29 +317,28 @@ class Student(db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        credentials.forget_password(self)
+        self.password_hash = passwords.hash_password(password)
 
     # 验证密码哈希串
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return credentials.verify_password(self, password)
 
     # 生成token
     def generate_auth_token(self, expiration=600):
         s = Serializer(current_app.config['SECRET_KEY'], expires_in=expiration)
-        return s.dumps({'id': self.id, 'generate_time': json.dumps(datetime.utcnow(), default=lambda d: d.__str__())}).decode('utf-8')
+        from .units import capabilities
+        data = {'id': self.id, 'role': 'student', 'generate_time': json.dumps(datetime.utcnow(), default=lambda d: d.__str__())}
+        data.update(capabilities.claims(self, 'student'))
+        return s.dumps(data).decode('utf-8')
 
     @staticmethod
     def verify_auth_token(token):
-        s = Serializer(current_app.config['SECRET_KEY'])
-        try:
-            data = s.loads(token)
-        except:
-            return False
-        student_user = Student.query.get(data['id'])
-        return student_user
+        return load_token_user(Student, 'student', token)
 
     def join_school(self, school_id):
-        school = School.query.get(school_id)
+        from .units import membership
+        school = get_entity(School, school_id)
         # 将课程属性取出附给每个学校对应的学生
         course = school.courses.first()
         vip_times = course.vip_times
@@ -298,29 +351,59 @@ class Student(db.Model):
         )
         db.session.add(s_and_s)
         db.session.commit()
+        membership.invalidate_students(school.id)
+
+    @staticmethod
+    def provision_wx(school_id, openid, session_key):
+        """首次微信登录：在一个事务中创建学生和带 openid 的学校会员，返回学生。
+
+        并发请求已用同一 openid 建好会员时（wx_openid 唯一约束冲突），
+        回滚后改为更新该会员的 session_key，返回已有的学生。
+        """
+        from .units import membership
+        from .units.school_config import get_school_config
+        config = get_school_config(school_id)
+        if config is None:
+            abort(404, code=0, message='School not found')
+        # 提问次数取首个课程的设置，没有课程时用字段默认值
+        times = dict((k, getattr(config, k)) for k in ('vip_times', 'nomal_times')
+                     if getattr(config, k) is not None)
+        student = Student(nickname=' ')
+        db.session.add(SchoolStudent(
+            student=student,
+            school_id=config.id,
+            wx_openid=openid,
+            wx_sessionkey=session_key,
+            **times
+        ))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            member_info = SchoolStudent.query.filter_by(wx_openid=openid).first()
+            if member_info is None:
+                raise
+            member_info.wx_sessionkey = session_key
+            db.session.commit()
+            return get_entity(Student, member_info.student_id)
+        membership.invalidate_students(config.id)
+        return student
 
     def is_school_joined(self, school_id):
-        school = School.query.get(school_id)
-        if school is None:
-            return False
-        return school.students.filter_by(id=self.id).first() is not None
+        from .units import membership, capabilities
+        if capabilities.has_school(self, school_id):
+            return True
+        return membership.is_student(school_id, self.id)
 
     def can_ask(self, school_id):
-        school = School.query.get(school_id)
-        if school is None:
-            return False
+        if current_app.config.get('QUOTA_LEDGER'):
+            from .units import quota
+            return quota.can_ask(school_id, self.id)
         member_info = SchoolStudent.query.filter_by(
             school_id=school_id,
             student_id=self.id
-        ).first()
-        if member_info is None:
-            return False
-        if member_info.vip_expire > datetime.utcnow():
-            if member_info.vip_times == -1 or member_info.vip_times > 0:
-                return True
-        if member_info.nomal_times > 0:
-            return True
-        return False
+        ).filter(SchoolStudent.can_ask_clause(datetime.utcnow())).first()
+        return member_info is not None
 
 
 class Course(db.Model):
@@ -335,6 +418,13 @@ class Course(db.Model):
 
 class Ask(db.Model):
     __tablename__ = 'asks'
+    # 与学生端/学校端问题列表的过滤条件和 id 倒序一一对应
+    __table_args__ = (
+        db.Index('ix_asks_school_id_id', 'school_id', 'id'),
+        db.Index('ix_asks_school_id_be_answered_id', 'school_id', 'be_answered', 'id'),
+        db.Index('ix_asks_school_id_student_id_id', 'school_id', 'student_id', 'id'),
+        db.Index('ix_asks_school_id_student_id_be_answered_id', 'school_id', 'student_id', 'be_answered', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     ask_text = db.Column(db.Text)
@@ -351,6 +441,53 @@ class Ask(db.Model):
     )
     student_id = db.Column(db.Integer, db.ForeignKey('students.id'))
     school_id = db.Column(db.Integer, db.ForeignKey('schools.id'))
+    images = db.relationship(
+        'AskImage',
+        order_by='AskImage.position',
+        lazy='select',
+        cascade="all, delete-orphan"
+    )
+
+    # 问题详情：答案和图片一并预加载，查询数与答案条数无关
+    @staticmethod
+    def query_with_answers():
+        return Ask.query.options(
+            db.selectinload(Ask.images),
+            db.selectinload(Ask.answers).selectinload(Answer.images)
+        )
+
+    # 列表页：一次查询取出本页全部答案，每个问题最多 limit 条，放在 page_answers 上
+    @staticmethod
+    def preload_answers(asks, limit=None):
+        ids = [ask.id for ask in asks]
+        grouped = {}
+        if ids:
+            query = Answer.query.filter(Answer.ask_id.in_(ids))
+            if limit is not None:
+                # 每个问题的条数在数据库中截断，热门问题不会取回全部答案；
+                # 不用窗口函数（MySQL 8 以前不支持），每个问题一段 LIMIT 派生表再 UNION ALL，
+                # 派生表包一层是因为 MySQL 不允许 IN 子查询里直接带 LIMIT
+                capped = [
+                    db.select([sub.c.id]) for sub in (
+                        db.session.query(Answer.id.label('id')).filter(Answer.ask_id == ask_id).order_by(
+                            Answer.id
+                        ).limit(limit).subquery() for ask_id in ids
+                    )
+                ]
+                query = Answer.query.filter(Answer.id.in_(db.union_all(*capped) if len(capped) > 1 else capped[0]))
+            for answer in query.order_by(Answer.ask_id, Answer.id):
+                grouped.setdefault(answer.ask_id, []).append(answer)
+        for ask in asks:
+            ask.page_answers = grouped.get(ask.id, [])
+        return [answer for ask in asks for answer in ask.page_answers]
+
+    # img_ids 保留逗号串以兼容旧客户端，同时写入 ask_images
+    def set_images(self, img_ids):
+        self.img_ids = img_ids
+        self.images = [
+            AskImage(topicimage_id=i, position=n)
+            for n, i in enumerate(parse_img_ids(img_ids))
+        ]
 
     # 当增加或移除答案时，都要对be_answered值进行设置
     @staticmethod
@@ -378,7 +515,20 @@ class Answer(db.Model):
     img_ids = db.Column(db.String(256))
     student_id = db.Column(db.Integer, db.ForeignKey('students.id'))
     teacher_id = db.Column(db.Integer, db.ForeignKey('teachers.id'))
-    ask_id = db.Column(db.Integer, db.ForeignKey('asks.id'))
+    ask_id = db.Column(db.Integer, db.ForeignKey('asks.id'), index=True)
+    images = db.relationship(
+        'AnswerImage',
+        order_by='AnswerImage.position',
+        lazy='select',
+        cascade="all, delete-orphan"
+    )
+
+    def set_images(self, img_ids):
+        self.img_ids = img_ids
+        self.images = [
+            AnswerImage(topicimage_id=i, position=n)
+            for n, i in enumerate(parse_img_ids(img_ids))
+        ]
 
 
 class Topicimage(db.Model):
@@ -391,9 +541,264 @@ class Topicimage(db.Model):
     img_sort = db.Column(db.Integer)
 
 
+class AskImage(db.Model):
+    __tablename__ = 'ask_images'
+    ask_id = db.Column(db.Integer, db.ForeignKey('asks.id'), primary_key=True)
+    topicimage_id = db.Column(db.Integer, db.ForeignKey('topicimages.id'), primary_key=True)
+    position = db.Column(db.Integer, default=0)
+    image = db.relationship('Topicimage', lazy='joined')
+
+
+class AnswerImage(db.Model):
+    __tablename__ = 'answer_images'
+    answer_id = db.Column(db.Integer, db.ForeignKey('answers.id'), primary_key=True)
+    topicimage_id = db.Column(db.Integer, db.ForeignKey('topicimages.id'), primary_key=True)
+    position = db.Column(db.Integer, default=0)
+    image = db.relationship('Topicimage', lazy='joined')
+
+
 class Feedback(db.Model):
     __tablename__ = 'feedbacks'
     id = db.Column(db.Integer, primary_key=True)
     fb_text = db.Column(db.Text)
     fb_contact = db.Column(db.String(64))
     student_id = db.Column(db.Integer, db.ForeignKey('students.id'))
+
+
+class SchoolCounter(db.Model):
+    """学校及学校内学生的问题数、学生数、教师数，列表接口直接读取，不再 COUNT(*)。
+
+    student_id 为 0 的行是全校汇总。计数由 after_flush 增量维护，
+    行不存在时按实际数据初始化，漂移可用 flask reconcile_counters 修复。
+    """
+    __tablename__ = 'school_counters'
+    school_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    student_id = db.Column(db.Integer, primary_key=True, autoincrement=False, default=0)
+    answered = db.Column(db.Integer, default=0)
+    unanswered = db.Column(db.Integer, default=0)
+    students = db.Column(db.Integer, default=0)
+    teachers = db.Column(db.Integer, default=0)
+
+    # 问题总数，be_answered 为 None 时返回全部
+    def asks(self, be_answered=None):
+        if be_answered is None:
+            return self.answered + self.unanswered
+        return self.answered if be_answered else self.unanswered
+
+    @staticmethod
+    def count_actual(school_id, student_id=0):
+        query = db.session.query(Ask.be_answered, db.func.count(Ask.id)).filter(
+            Ask.school_id == school_id
+        )
+        if student_id:
+            query = query.filter(Ask.student_id == student_id)
+        values = {'answered': 0, 'unanswered': 0, 'students': 0, 'teachers': 0}
+        for be_answered, n in query.group_by(Ask.be_answered):
+            values['answered' if be_answered else 'unanswered'] += n
+        if not student_id:
+            values['students'] = SchoolStudent.query.filter_by(school_id=school_id).count()
+            values['teachers'] = db.session.query(employs).filter(
+                employs.c.school_id == school_id
+            ).count()
+        return values
+
+    @staticmethod
+    def fetch(school_id, student_id=0):
+        school_id = int(school_id)
+        student_id = int(student_id)
+        counter = SchoolCounter.query.get((school_id, student_id))
+        if counter is not None:
+            return counter
+        counter = SchoolCounter(
+            school_id=school_id,
+            student_id=student_id,
+            **SchoolCounter.count_actual(school_id, student_id)
+        )
+        db.session.add(counter)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # 并发请求已经初始化过
+            db.session.rollback()
+            counter = SchoolCounter.query.get((school_id, student_id))
+        return counter
+
+    @staticmethod
+    def reconcile():
+        """按实际数据修正全部计数行，返回被修正的行数。"""
+        fixed = 0
+        for counter in SchoolCounter.query.all():
+            actual = SchoolCounter.count_actual(counter.school_id, counter.student_id)
+            if any(getattr(counter, k) != v for k, v in actual.items()):
+                for k, v in actual.items():
+                    setattr(counter, k, v)
+                fixed += 1
+        db.session.commit()
+        return fixed
+
+
+def _counter_bump(deltas, school_id, student_id, field, n):
+    if school_id is None:
+        return
+    key = (school_id, student_id or 0)
+    fields = deltas.setdefault(key, {})
+    fields[field] = fields.get(field, 0) + n
+
+
+def _counter_ask_field(be_answered):
+    return 'answered' if be_answered else 'unanswered'
+
+
+def update_counters_after_flush(session, flush_context):
+    deltas = {}
+    stale = set()
+    dropped = set()
+    for obj in session.new:
+        if isinstance(obj, Ask):
+            field = _counter_ask_field(obj.be_answered)
+            _counter_bump(deltas, obj.school_id, 0, field, 1)
+            _counter_bump(deltas, obj.school_id, obj.student_id, field, 1)
+        elif isinstance(obj, SchoolStudent):
+            _counter_bump(deltas, obj.school_id, 0, 'students', 1)
+        elif isinstance(obj, Teacher):
+            for school in obj.schools:
+                _counter_bump(deltas, school.id, 0, 'teachers', 1)
+    for obj in session.deleted:
+        state = db.inspect(obj)
+        if isinstance(obj, Ask):
+            school_id = state.dict.get('school_id')
+            student_id = state.dict.get('student_id')
+            if 'be_answered' not in state.dict:
+                stale.update([(school_id, 0), (school_id, student_id or 0)])
+                continue
+            field = _counter_ask_field(state.dict['be_answered'])
+            _counter_bump(deltas, school_id, 0, field, -1)
+            _counter_bump(deltas, school_id, student_id, field, -1)
+        elif isinstance(obj, SchoolStudent):
+            _counter_bump(deltas, state.dict.get('school_id'), 0, 'students', -1)
+        elif isinstance(obj, Teacher):
+            for school in state.dict.get('schools', []):
+                _counter_bump(deltas, school.id, 0, 'teachers', -1)
+        elif isinstance(obj, School):
+            dropped.add(obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, Ask):
+            history = db.inspect(obj).attrs.be_answered.history
+            if not history.added:
+                continue
+            new = bool(history.added[0])
+            if not history.deleted:
+                # 旧值未加载，无法判断增量，交给下次读取时重算
+                stale.update([(obj.school_id, 0), (obj.school_id, obj.student_id or 0)])
+                continue
+            if bool(history.deleted[0]) == new:
+                continue
+            for student_id in (0, obj.student_id):
+                _counter_bump(deltas, obj.school_id, student_id, _counter_ask_field(new), 1)
+                _counter_bump(deltas, obj.school_id, student_id, _counter_ask_field(not new), -1)
+        elif isinstance(obj, Teacher):
+            # schools 未加载时 history 中为 None
+            history = db.inspect(obj).attrs.schools.history
+            for school in history.added or ():
+                _counter_bump(deltas, school.id, 0, 'teachers', 1)
+            for school in history.deleted or ():
+                _counter_bump(deltas, school.id, 0, 'teachers', -1)
+
+    table = SchoolCounter.__table__
+    for (school_id, student_id), fields in deltas.items():
+        if (school_id, student_id) in stale or school_id in dropped:
+            continue
+        values = {k: getattr(table.c, k) + n for k, n in fields.items() if n}
+        if values:
+            session.execute(table.update().where(
+                table.c.school_id == school_id
+            ).where(
+                table.c.student_id == student_id
+            ).values(**values))
+    for school_id, student_id in stale:
+        if school_id is not None:
+            session.execute(table.delete().where(
+                table.c.school_id == school_id
+            ).where(
+                table.c.student_id == (student_id or 0)
+            ))
+    for school_id in dropped:
+        session.execute(table.delete().where(table.c.school_id == school_id))
+
+
+db.event.listen(db.session, 'after_flush', update_counters_after_flush)
+
+
+def invalidate_principals_after_flush(session, flush_context):
+    roles = {Admin: 'admin', Teacher: 'teacher', Student: 'student'}
+    for obj in session.deleted:
+        role = roles.get(type(obj))
+        if role:
+            invalidate_principal(role, obj.id)
+    for obj in session.dirty:
+        role = roles.get(type(obj))
+        if role is None:
+            continue
+        attrs = db.inspect(obj).attrs
+        for name in ('telephone', 'disabled'):
+            if name in attrs.keys() and attrs[name].history.has_changes():
+                invalidate_principal(role, obj.id)
+                break
+
+
+db.event.listen(db.session, 'after_flush', invalidate_principals_after_flush)
+
+
+# 学校或课程有变化时清除学校配置缓存
+def invalidate_school_config_after_flush(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, School):
+            invalidate_school_config(obj.id)
+        elif isinstance(obj, Course):
+            history = db.inspect(obj).attrs.school_id.history
+            for school_id in set(history.added or ()) | set(history.deleted or ()) | {obj.school_id}:
+                invalidate_school_config(school_id)
+
+
+db.event.listen(db.session, 'after_flush', invalidate_school_config_after_flush)
+
+
+# 成员关系、学校管理员或老师手机号变化时记下受影响的用户，提交后递增其权限版本
+def track_capabilities_after_flush(session, flush_context):
+    changed = session.info.setdefault('capability_changes', set())
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, SchoolStudent):
+            state = db.inspect(obj)
+            changed.add(('student', obj.student_id or state.committed_state.get('student_id')))
+    for obj in session.deleted:
+        if isinstance(obj, Teacher):
+            changed.add(('teacher', obj.id))
+    for obj in session.dirty:
+        if isinstance(obj, Teacher):
+            attrs = db.inspect(obj).attrs
+            if attrs.schools.history.has_changes() or attrs.telephone.history.has_changes():
+                changed.add(('teacher', obj.id))
+        elif isinstance(obj, School):
+            history = db.inspect(obj).attrs.admin.history
+            telephones = [t for t in list(history.added) + list(history.deleted) if t]
+            if telephones:
+                for teacher_id, in session.query(Teacher.id).filter(Teacher.telephone.in_(telephones)):
+                    changed.add(('teacher', teacher_id))
+
+
+def bump_capabilities_after_commit(session):
+    changed = session.info.pop('capability_changes', None)
+    if changed:
+        from .units import capabilities
+        for role, user_id in changed:
+            if user_id is not None:
+                capabilities.bump(role, user_id)
+
+
+def drop_capabilities_after_rollback(session, previous_transaction):
+    session.info.pop('capability_changes', None)
+
+
+db.event.listen(db.session, 'after_flush', track_capabilities_after_flush)
+db.event.listen(db.session, 'after_commit', bump_capabilities_after_commit)
+db.event.listen(db.session, 'after_soft_rollback', drop_capabilities_after_rollback)
@@ -10,8 +10,10 @@ from webargs import fields, validate
 from webargs.flaskparser import use_args
 from requests.exceptions import ReadTimeout, ConnectTimeout, ConnectionError as _ConnectionError
 from ..models import Teacher, Student, Topicimage, School, SchoolStudent
+from ..units.loader import get_entity
+from ..units.principals import load_any_token_user
+from ..units import verification
 from .. import db
-from .. import redis_store
 from . import public_api
 
 
@@ -21,28 +23,31 @@ basedir = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pard
 
 
 def abort_if_school_doesnt_exist(id):
-    if School.query.get(id) is None:
+    entity = get_entity(School, id)
+    if entity is None:
         abort(404, code=0, message='学校不存在')
+    return entity
+
+
+# 上传文件记录的用户类型
+USER_TYPES = {'teacher': 1, 'student': 2}
+PUBLIC_ROLES = [('teacher', Teacher), ('student', Student)]
 
 
 @auth.verify_password
 def verify_password(username_or_token, password):
-    teacher_user = Teacher.verify_auth_token(username_or_token)
-    student_user = Student.verify_auth_token(username_or_token)
-    if not (teacher_user or student_user):
-        teacher_user = Teacher.query.filter_by(telephone=username_or_token).first()
-        student_user = Student.query.filter_by(telephone=username_or_token).first()
-        if teacher_user:
-            t = teacher_user.verify_password(password)
-        if student_user:
-            s = student_user.verify_password(password)
-        if (not teacher_user or not t) and (not student_user or not s):
+    user, role = load_any_token_user(username_or_token, PUBLIC_ROLES)
+    if not user:
+        # 手机号登录，先老师后学生，找到并验证通过即停止
+        for role, model in PUBLIC_ROLES:
+            user = model.query.filter_by(telephone=username_or_token).first()
+            if user and user.verify_password(password):
+                break
+            user = None
+        if user is None:
             return False
-    g.user = teacher_user or student_user
-    if teacher_user:
-        g.user.user_type = 1
-    if student_user:
-        g.user.user_type = 2
+    g.user = user
+    g.user.user_type = USER_TYPES[role]
     return True
 
 
@@ -170,16 +175,9 @@ class TeacherReg(Resource):
     @use_args(teacher_regs)
     def post(self, args):
         # 验证短信码
-        auuid = args['uuid']
-        inputvalue = args['phonecode']
         telephone = args['telephone']
-        value = redis_store.get(auuid)
-        if not value:
+        if not verification.check_sms_code(args['uuid'], telephone, args['phonecode']):
             abort(403, code=0, message='验证码错误')
-        if value.decode('utf-8') != (telephone + inputvalue):
-            redis_store.delete(auuid)
-            abort(403, code=0, message='验证码错误')
-        redis_store.delete(auuid)
 
         if Teacher.query.filter_by(telephone=telephone).first():
             abort(401, code=0, message='教师已经存在')
@@ -230,23 +228,16 @@ class WxTeacherReg(Resource):
     @use_args(teacher_regs)
     def put(self, args):
         teacher_id = args['teacher_id']
-        auuid = args['uuid']
-        inputvalue = args['phonecode']
         telephone = args['telephone']
         password = args['password']
         # 验证短信码
-        value = redis_store.get(auuid)
-        if not value:
-            abort(403, code=0, message='验证码错误')
-        if value.decode('utf-8') != (telephone + inputvalue):
-            redis_store.delete(auuid)
+        if not verification.check_sms_code(args['uuid'], telephone, args['phonecode']):
             abort(403, code=0, message='验证码错误')
-        redis_store.delete(auuid)
 
         if Teacher.query.filter_by(telephone=telephone).first():
             abort(401, code=0, message='手机已经绑定到其他账户')
 
-        teacher = Teacher.query.get(teacher_id)
+        teacher = get_entity(Teacher, teacher_id)
         teacher.telephone = telephone
         teacher.password = password
         db.session.commit()
@@ -275,8 +266,7 @@ class SchoolInfo(Resource):
 
     @marshal_with(school_info)
     def get(self, school_id):
-        abort_if_school_doesnt_exist(school_id)
-        school = School.query.get(school_id)
+        school = abort_if_school_doesnt_exist(school_id)
         course = school.courses.all()[0]
         result = {
             'code': 1,
@@ -2,24 +2,23 @@ import os
 import re
 import hashlib
 import time
-import requests
 import uuid
-import random
-from flask import g, request, current_app
+import base64
+from flask import g, request, current_app, make_response
 from flask_restful import Resource, abort, marshal_with, fields as rfields
 from webargs import fields, validate
 from webargs.flaskparser import use_args
-from requests.exceptions import ReadTimeout, ConnectTimeout, ConnectionError as _ConnectionError
-from ..models import Teacher, Student, Topicimage, School, SchoolStudent
+from requests.exceptions import ReadTimeout, ConnectTimeout, RequestException
+from ..models import Admin, Teacher, Student, Topicimage, SchoolStudent
 from .. import db
 from .. import redis_store
 from . import public_api
-from ..units import vercode
+from ..units import vercode, captcha_pool, imgcode_janitor, verification
+from ..units.loader import get_entity
+from ..units.wxclient import wx_client
+from ..units.school_config import get_school_config
+from ..units import refresh_tokens
 from ..units import WXBizDataCrypt
-from ..dysms_python import demo_sms_send
-
-TIMEOUT = 2
-wxurl = 'https://api.weixin.qq.com/sns/jscode2session'
 
 
 class ConnectTimeoutError(Exception):
@@ -52,18 +51,17 @@ class WxStudentLogin(Resource):
     @use_args(wxlogin_args)
     def post(self, args):
         sc_id = args['school_id']
-        school = School.query.get(sc_id)
+        school = get_school_config(sc_id)
         if school is None:
             abort(404, code=0, message='School not found')
         appid = school.wx_appid
         appsecret = school.wx_appsecret
         code = args['code']
-        wxparams = {'appid': appid, 'secret': appsecret, 'js_code': code, 'grant_type': 'authorization_code'}
         try:
-            r = requests.get(wxurl, params=wxparams, timeout=TIMEOUT).json()
+            r = wx_client().jscode2session(appid, appsecret, code)
         except (ConnectTimeout, ReadTimeout):
             raise ConnectTimeoutError(0, 'wx server connect timeout')
-        except _ConnectionError:
+        except (RequestException, ValueError):
             raise ConnectionError(0, 'wx server connect error')
         # 判断微信返回errcode
         errcode = r.get('errcode', 0)
@@ -78,25 +76,25 @@ class WxStudentLogin(Resource):
             member_info.wx_sessionkey = session_key
             db.session.commit()
             student_id = member_info.student_id
-            student = Student.query.get(student_id)
+            student = get_entity(Student, student_id)
             token = student.generate_auth_token(60*60*24*15)
             # 注意删除 openid sessinkey
-            return {'code': 1, 'student_id': student_id, 'token': token}, 200
+            return {
+                'code': 1,
+                'student_id': student_id,
+                'token': token,
+                'refresh_token': refresh_tokens.issue('student', student_id)
+            }, 200
 
-        # 新的openid入库
-        newstudent = Student(nickname=' ')
-        db.session.add(newstudent)
-        db.session.commit()
-        newstudent.join_school(sc_id)
-        member_info = SchoolStudent.query.filter_by(
-            school_id=sc_id,
-            student_id=newstudent.id
-        ).first()
-        member_info.wx_openid = openid
-        member_info.wx_sessionkey = session_key
-        db.session.commit()
+        # 新的openid入库，学生与会员一次提交
+        newstudent = Student.provision_wx(sc_id, openid, session_key)
         token = newstudent.generate_auth_token(60*60*24*15)
-        return {'code': 1, 'student_id': newstudent.id, 'token': token}, 200
+        return {
+            'code': 1,
+            'student_id': newstudent.id,
+            'token': token,
+            'refresh_token': refresh_tokens.issue('student', newstudent.id)
+        }, 200
 
 
 # 微信鉴权老师
@@ -109,6 +107,7 @@ class WxTeacherLogin(Resource):
     teacher_info = {
         'code': rfields.Integer,
         'token': rfields.String,
+        'refresh_token': rfields.String,
         'teacher': rfields.Nested({
             'id': rfields.Integer,
             'nickname': rfields.String,
@@ -125,12 +124,11 @@ class WxTeacherLogin(Resource):
         appid = os.getenv('WX_APPID')
         appsecret = os.getenv('WX_APPSECRET')
         code = args['code']
-        wxparams = {'appid': appid, 'secret': appsecret, 'js_code': code, 'grant_type': 'authorization_code'}
         try:
-            r = requests.get(wxurl, params=wxparams, timeout=TIMEOUT).json()
+            r = wx_client().jscode2session(appid, appsecret, code)
         except (ConnectTimeout, ReadTimeout):
             raise ConnectTimeoutError(0, 'wx server connect timeout')
-        except _ConnectionError:
+        except (RequestException, ValueError):
             raise ConnectionError(0, 'wx server connect error')
         errcode = r.get('errcode', 0)
         if errcode:
@@ -150,7 +148,8 @@ class WxTeacherLogin(Resource):
             result = {
                 'code': 1,
                 'teacher': teacher,
-                'token': token
+                'token': token,
+                'refresh_token': refresh_tokens.issue('teacher', teacher.id)
             }
             return result, 200
 
@@ -165,7 +164,8 @@ class WxTeacherLogin(Resource):
         result = {
             'code': 1,
             'teacher': newteacher,
-            'token': token
+            'token': token,
+            'refresh_token': refresh_tokens.issue('teacher', newteacher.id)
         }
 
         return result, 200
@@ -187,10 +187,10 @@ class StudentWeiXinSecret(Resource):
 
     @use_args(wx_info)
     def put(self, args, school_id, student_id):
-        school = School.query.get(school_id)
+        school = get_school_config(school_id)
         if school is None:
             abort(404, code=0, message='school not found')
-        student = Student.query.get(student_id)
+        student = get_entity(Student, student_id)
         if student is None:
             abort(404, code=0, message='Student not found')
         # 存入公开数据
@@ -239,7 +239,7 @@ class TeacherWeiXinSecret(Resource):
 
     @use_args(wx_info)
     def put(self, args, teacher_id):
-        teacher = Teacher.query.get(teacher_id)
+        teacher = get_entity(Teacher, teacher_id)
         if teacher is None:
             abort(404, code=0, message='teacher not found')
         # 存入公开数据
@@ -288,6 +288,7 @@ class ImgCode(Resource):
         codeinfo = generateImgCode.create(imgcodefile)
         codevalue = codeinfo.get('codeValue')
         filename = codeinfo.get('fileName')
+        imgcode_janitor.track(filename)
         imgurl = 'imgcodes/' + filename
         auuid = str(uuid.uuid1())
         # 将uuid和对应的code值存入redis
@@ -312,6 +313,28 @@ class ImgCode(Resource):
         return {'code': 0}, 403
 
 
+# 从验证码池取图片验证码，直接返回图片或 data URI
+class Captcha(Resource):
+    captcha_args = {
+        'format': fields.Str(validate=validate.OneOf(['jpeg', 'datauri']), missing='jpeg')
+    }
+
+    @use_args(captcha_args)
+    def get(self, args):
+        auuid, img = captcha_pool.take()
+        if args['format'] == 'datauri':
+            return {
+                'code': 1,
+                'auuid': auuid,
+                'imgdata': 'data:image/jpeg;base64,' + base64.b64encode(img).decode('ascii')
+            }
+        response = make_response(img)
+        response.headers['Content-Type'] = 'image/jpeg'
+        response.headers['Cache-Control'] = 'no-store'
+        response.headers['X-Captcha-Uuid'] = auuid
+        return response
+
+
 # 短信验证码
 class SendSMS(Resource):
 
@@ -326,46 +349,43 @@ class SendSMS(Resource):
 
     @use_args(sms_args)
     def post(self, args):
-        phone_numbers = args['phone_numbers']
-
-        # 验证图片码
-        auuid = args['uuid']
-        inputvalue = args['inputvalue']
-        value = redis_store.get(auuid)
-        if value is None:
+        # 验证图片码、60s防刷，通过后保存短信码并放入发送队列，由 sms_worker 发送
+        status, smsuuid = verification.send_sms_code(args['uuid'], args['inputvalue'], args['phone_numbers'])
+        if status == verification.CODE_INVALID:
             return {'code': 0, 'message': '验证码错误'}, 403
-        if value.decode('utf-8') != inputvalue:
-            redis_store.delete(auuid)
-            return {'code': 0, 'message': '验证码错误'}, 403
-        redis_store.delete(auuid)
-
-        # 检测手机号是否在60s内存在,返回0可继续
-        phone_status = redis_store.exists(phone_numbers)
-        if phone_status:
+        if status == verification.THROTTLED:
             return {'code': 0, 'message': '请求太频繁'}, 403
 
-        # 生成短信内容
-        smsuuid = phone_numbers + '-' + str(uuid.uuid1())
-        rndcode = ''
-        for t in range(6):
-            num = str(random.randint(0, 9))
-            rndcode += num
-        sign_name = '麦学习软件'
-        params = {'code': rndcode, 'product': '麦学习答疑'}
+        return {'code': 1, 'uuid': smsuuid}, 200
 
-        # 调用发送接口
-        send_result = demo_sms_send.send_sms(smsuuid, phone_numbers, sign_name, 'SMS_76030398', params)
 
-        # 存值到redis
-        value = phone_numbers + rndcode
-        redis_store.setex(smsuuid, 3600, value)
+# 用刷新 token 换新的访问 token，刷新 token 同时轮换
+class RefreshToken(Resource):
 
-        # 手机入库60s防刷
-        redis_store.setex(phone_numbers, 60, 'x')
+    refresh_args = {
+        'refresh_token': fields.Str(required=True)
+    }
 
-        print(send_result)
+    models = {'admin': Admin, 'teacher': Teacher, 'student': Student}
 
-        return {'code': 1, 'uuid': smsuuid}, 200
+    @use_args(refresh_args)
+    def post(self, args):
+        rotated = refresh_tokens.rotate(args['refresh_token'])
+        if rotated is None:
+            abort(401, code=0, message='刷新token无效或已过期')
+        role, user_id, refresh_token = rotated
+        user = get_entity(self.models[role], user_id)
+        if user is None:
+            refresh_tokens.revoke(refresh_token)
+            abort(401, code=0, message='用户不存在')
+        return {
+            'code': 1,
+            'role': role,
+            'user_id': user_id,
+            'token': user.generate_auth_token(600),
+            'expiration': 600,
+            'refresh_token': refresh_token
+        }
 
 
 # 验证手机号存在
@@ -383,5 +403,7 @@ public_api.add_resource(StudentWeiXinSecret, '/studentwxsecret/<int:school_id>/<
 public_api.add_resource(TeacherWeiXinSecret, '/teacherwxsecret/<int:teacher_id>')
 
 public_api.add_resource(ImgCode, '/imgcode')
+public_api.add_resource(Captcha, '/captcha')
 public_api.add_resource(PhoneExist, '/phoneexist/<telephone>')
+public_api.add_resource(RefreshToken, '/token/refresh')
 public_api.add_resource(SendSMS, '/sendsms')
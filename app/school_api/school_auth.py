@@ -4,6 +4,7 @@ from flask_httpauth import HTTPBasicAuth
 from webargs import fields
 from webargs.flaskparser import use_args
 from ..models import Teacher
+from ..units import refresh_tokens
 from . import school_api, school_api_bp
 
 auth = HTTPBasicAuth()
@@ -12,10 +13,12 @@ auth = HTTPBasicAuth()
 @auth.verify_password
 def verify_password(username_or_token, password):
     teacher_user = Teacher.verify_auth_token(username_or_token)
+    g.password_auth = False
     if not teacher_user:
         teacher_user = Teacher.query.filter_by(telephone=username_or_token).first()
         if not teacher_user or not teacher_user.verify_password(password):
             return False
+        g.password_auth = True
     g.teacher_user = teacher_user
     return True
 
@@ -34,7 +37,21 @@ def auth_error():
 class GetToken(Resource):
     def get(self):
         token = g.teacher_user.generate_auth_token(600)
-        return {'code': 1, 'token': token, 'expiration': 600}
+        result = {
+            'code': 1,
+            'token': token,
+            'expiration': 600
+        }
+        # 只有用密码登录时才发刷新 token，访问 token 不能用来续出新的会话
+        if g.password_auth:
+            result['refresh_token'] = refresh_tokens.issue('teacher', g.teacher_user.id)
+        return result
+
+
+class Sessions(Resource):
+    def delete(self):
+        revoked = refresh_tokens.revoke_all('teacher', g.teacher_user.id)
+        return {'code': 1, 'revoked': revoked}
 
 
 # use_args
@@ -52,4 +69,5 @@ class TeacherBindSchool(Resource):
 
 
 school_api.add_resource(GetToken, '/token')
+school_api.add_resource(Sessions, '/sessions')
 school_api.add_resource(TeacherBindSchool, '/bind')
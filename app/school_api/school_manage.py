@@ -5,7 +5,13 @@ from datetime import datetime
 from flask_restful import Resource, marshal_with, abort, fields as rfields
 from webargs import fields, validate
 from webargs.flaskparser import use_args
-from ..models import Teacher, School, Student, SchoolStudent, Ask, Answer, Topicimage
+from ..models import Teacher, School, Student, SchoolStudent, Ask, Answer, SchoolCounter
+from ..units.topicimgs import attach_imgs, resolve_img_ids
+from ..units.paging import KeysetPage, counted_paginate
+from ..units.authors import attach_authors
+from ..units import quota
+from ..units import membership
+from ..units.loader import get_entity
 from .. import redis_store
 from .. import db
 from . import school_api
@@ -90,28 +96,38 @@ student_info = {
 
 
 def abort_if_school_doesnt_exist(id):
-    if School.query.get(id) is None:
+    entity = get_entity(School, id)
+    if entity is None:
         abort(404, code=0, message='学校不存在')
+    return entity
 
 
 def abort_if_teacher_doesnt_exist(id):
-    if Teacher.query.get(id) is None:
+    entity = get_entity(Teacher, id)
+    if entity is None:
         abort(404, code=0, message='教师不存在')
+    return entity
 
 
 def abort_if_student_doesnt_exist(id):
-    if Student.query.get(id) is None:
+    entity = get_entity(Student, id)
+    if entity is None:
         abort(404, code=0, message='学生不存在')
+    return entity
 
 
 def abort_if_ask_doesnt_exist(id):
-    if Ask.query.get(id) is None:
+    entity = get_entity(Ask, id)
+    if entity is None:
         abort(404, code=0, message='问题不存在')
+    return entity
 
 
 def abort_if_answer_doesnt_exist(id):
-    if Answer.query.get(id) is None: 
+    entity = get_entity(Answer, id)
+    if entity is None:
         abort(404, code=0, message='答案不存在')
+    return entity
 
 
 class Coursex(Resource):
@@ -168,13 +184,13 @@ class SchoolDetail(Resource):
 
     @marshal_with(school_info, envelope='resource')
     def get(self, s_id):
-        abort_if_school_doesnt_exist(s_id)
+        school = abort_if_school_doesnt_exist(s_id)
         if g.teacher_user.is_employ(s_id) is False:
             abort(401, message='不是这个学校的老师')
-        school = School.query.get(s_id)
+        counter = SchoolCounter.fetch(s_id)
         school.teacherslist = school.teachers.all()
-        school.teachercount = school.teachers.count()
-        school.studentcount = school.students.count()
+        school.teachercount = counter.teachers
+        school.studentcount = counter.students
         return school, 200
 
 
@@ -201,7 +217,7 @@ class TeacherInfo(Resource):
 
     @marshal_with(teacher_info)
     def get(self, t_id):
-        teacher = Teacher.query.get(t_id)
+        teacher = get_entity(Teacher, t_id)
         if g.teacher_user.id != int(t_id):
             abort(403, code=0, message='没有权限')
         teacher.register = True
@@ -230,11 +246,10 @@ class TeacherDetail(Resource):
 
     @marshal_with(teacher_info, envelope='resource')
     def get(self, s_id, t_id):
-        abort_if_teacher_doesnt_exist(t_id)
+        teacher = abort_if_teacher_doesnt_exist(t_id)
         abort_if_school_doesnt_exist(s_id)
         if g.teacher_user.is_employ(s_id) is False:
             abort(401, message='你不是这个学校的老师')
-        teacher = Teacher.query.get(t_id)
         if teacher.is_employ(s_id) is False:
             abort(401, message='他/她不是这里的老师')
         teacher.answerscount = teacher.answers.count()
@@ -246,12 +261,10 @@ class DismissTeacher(Resource):
     def delete(self, args):
         s_id = args['school_id']
         t_id = args['teacher_id']
-        abort_if_school_doesnt_exist(s_id)
-        abort_if_teacher_doesnt_exist(t_id)
-        school = School.query.get(s_id)
+        school = abort_if_school_doesnt_exist(s_id)
+        teacher = abort_if_teacher_doesnt_exist(t_id)
         if g.teacher_user.is_teacher_admin(s_id) is False:
             abort(401, message='没有学校管理员权限')
-        teacher = Teacher.query.get(t_id)
         if teacher.telephone == school.admin:
             abort(401, message='不能移除自己')
         if teacher.is_employ(s_id) is False:
@@ -275,12 +288,11 @@ class StudentList(Resource):
     @marshal_with(student_paging_list, envelope='resource')
     @use_args(student_list)
     def get(self, args, s_id):
-        abort_if_school_doesnt_exist(s_id)
+        school = abort_if_school_doesnt_exist(s_id)
         page = args['page']
         per_page = args['per_page']
         if g.teacher_user.is_employ(s_id) is False:
             abort(401, message='你不是这里的老师')
-        school = School.query.get(s_id)
         pagination = school.students.paginate(
             page=page, per_page=per_page, error_out=True
         )
@@ -306,16 +318,14 @@ class Studentx(Resource):
         if g.teacher_user.is_employ(school_id) is False:
             abort(401, message='你不是这里的老师')
         abort_if_school_doesnt_exist(school_id)
-        abort_if_student_doesnt_exist(student_id)
-        student = Student.query.get(student_id)
+        student = abort_if_student_doesnt_exist(student_id)
         if student.is_school_joined is False:
             abort(401, message='该学校没有此学生')
         member_info = SchoolStudent.query.filter_by(
             school_id=school_id,
             student_id=student_id
         ).first()
-        student.vip_times = member_info.vip_times
-        student.nomal_times = member_info.nomal_times
+        student.vip_times, student.nomal_times = quota.times(member_info)
         student.vip_expire = member_info.vip_expire
         student.join_timestamp = member_info.timestamp
         return student, 200
@@ -326,8 +336,7 @@ class Studentx(Resource):
         if g.teacher_user.is_employ(school_id) is False:
             abort(401, message='你不是这里的老师')
         abort_if_school_doesnt_exist(school_id)
-        abort_if_student_doesnt_exist(student_id)
-        student = Student.query.get(student_id)
+        student = abort_if_student_doesnt_exist(student_id)
         if student.is_school_joined is False:
             abort(401, message='该学校没有此学生')
         member_info = SchoolStudent.query.filter_by(
@@ -339,6 +348,8 @@ class Studentx(Resource):
         member_info.vip_expire = args['vip_expire']
         db.session.add(member_info)
         db.session.commit()
+        # 次数用提交的值覆盖账本；vip_expire 不经账本写回，可直接读库
+        quota.reset(school_id, student_id, args['vip_times'], args['nomal_times'], member_info.vip_expire)
         student.vip_times = member_info.vip_times
         student.nomal_times = member_info.nomal_times
         student.vip_expire = member_info.vip_expire
@@ -352,8 +363,10 @@ class Questions(Resource):
         'school_id': fields.Int(required=True),
         'student_id': fields.Int(missing='0'),
         'page': fields.Int(missing=1),
-        'per_page': fields.Int(missing=10),
-        'answered': fields.Int(validate=validate.OneOf([0, 1, 2]), missing=0)
+        'per_page': fields.Int(validate=validate.Range(min=1), missing=10),
+        'answered': fields.Int(validate=validate.OneOf([0, 1, 2]), missing=0),
+        'cursor': fields.Str(missing=None),
+        'answer_limit': fields.Int(missing=None, validate=lambda x: x >= 0)
     }
 
     answer_info = {
@@ -378,7 +391,7 @@ class Questions(Resource):
         'voice_url': rfields.String,
         'voice_duration': rfields.String,
         'imgs': rfields.List(rfields.String),
-        'answers': rfields.Nested(answer_info),
+        'answers': rfields.Nested(answer_info, attribute='page_answers'),
         'be_answered': rfields.Boolean,
         'answer_grate': rfields.Integer
     }
@@ -387,6 +400,7 @@ class Questions(Resource):
         'asks': rfields.Nested(ask_info),
         'prev': rfields.String,
         'next': rfields.String,
+        'next_cursor': rfields.String,
         'count': rfields.Integer
     }
 
@@ -401,72 +415,48 @@ class Questions(Resource):
         abort_if_school_doesnt_exist(sc_id)
         if g.teacher_user.is_employ(sc_id) is False:
             abort(401, message='你不是这里的老师')
-        if st_id == 0:
-            if answered == 0:
-                pagination = Ask.query.filter_by(school_id=sc_id).paginate(
-                    page=page, per_page=per_page, error_out=True
-                )
-            if answered == 1:
-                pagination = Ask.query.filter_by(
-                    school_id=sc_id, be_answered=False
-                ).paginate(
-                    page=page, per_page=per_page, error_out=True
-                )
-            if answered == 2:
-                pagination = Ask.query.filter_by(
-                    school_id=sc_id, be_answered=True
-                ).paginate(
-                    page=page, per_page=per_page, error_out=True
-                )
-        else:
-            abort_if_student_doesnt_exist(st_id)
-            student = Student.query.get(st_id)
+        query = Ask.query.filter_by(school_id=sc_id)
+        if st_id != 0:
+            student = abort_if_student_doesnt_exist(st_id)
             if student.is_school_joined(sc_id) is False:
                 abort(401, message='不是这个学校/机构的学生')
-            if answered == 0:
-                pagination = Ask.query.filter_by(
-                    school_id=sc_id,
-                    student_id=st_id
-                ).paginate(
-                    page=page, per_page=per_page, error_out=True
-                )
-            if answered == 1:
-                pagination = Ask.query.filter_by(
-                    school_id=sc_id,
-                    student_id=st_id,
-                    be_answered=False
-                ).paginate(
-                    page=page, per_page=per_page, error_out=True
-                )
-            if answered == 2:
-                pagination = Ask.query.filter_by(
-                    school_id=sc_id,
-                    student_id=st_id,
-                    be_answered=True
-                ).paginate(
-                    page=page, per_page=per_page, error_out=True
-                )
-        asks = pagination.items
+            query = query.filter_by(student_id=st_id)
+        be_answered = None
+        if answered == 1:
+            be_answered = False
+        if answered == 2:
+            be_answered = True
+        if be_answered is not None:
+            query = query.filter_by(be_answered=be_answered)
+        count = SchoolCounter.fetch(sc_id, st_id).asks(be_answered)
         prev = None
-        if pagination.has_prev:
-            prev = url_for('school_api.asks', sc_id=sc_id, st_id=st_id, page=page-1, per_page=per_page)
         next = None
-        if pagination.has_next:
-            next = url_for('school_api.asks', sc_id=sc_id, st_id=st_id, page=page+1, per_page=per_page)
-        for ask in asks:
-            imgs = []
-            img_ids = ask.img_ids
-            if img_ids:
-                img_list = img_ids.rsplit(',')
-                for i in img_list:
-                    img = Topicimage.query.get(i)
-                    imgs.append(img.img_url)
-            ask.imgs = imgs
+        next_cursor = None
+        # 游标模式：不做 OFFSET 扫描
+        if args['cursor'] is not None:
+            keyset = KeysetPage(query, Ask.id, args['cursor'], per_page)
+            asks = keyset.items
+            next_cursor = keyset.next_cursor
+            if keyset.has_next:
+                next = url_for(
+                    'school_api.asks', school_id=sc_id, student_id=st_id,
+                    answered=answered, cursor=next_cursor, per_page=per_page
+                )
+        else:
+            pagination = counted_paginate(query, page, per_page, count)
+            asks = pagination.items
+            if pagination.has_prev:
+                prev = url_for('school_api.asks', sc_id=sc_id, st_id=st_id, page=page-1, per_page=per_page)
+            if pagination.has_next:
+                next = url_for('school_api.asks', sc_id=sc_id, st_id=st_id, page=page+1, per_page=per_page)
+        answers = Ask.preload_answers(asks, args['answer_limit'])
+        attach_imgs(asks, answers)
         result = {
             'asks': asks,
             'prev': prev,
             'next': next,
-            'count': pagination.total
+            'next_cursor': next_cursor,
+            'count': count
         }
         return result, 200
 
@@ -478,6 +468,10 @@ class Question(Resource):
         'student_id': rfields.Integer,
         'school_id': rfields.Integer,
         'teacher_id': rfields.Integer,
+        'teacher_nickname': rfields.String,
+        'teacher_imgurl': rfields.String(default=''),
+        'student_nickname': rfields.String,
+        'student_imgurl': rfields.String(default=''),
         'ask_id': rfields.Integer,
         'timestamp': rfields.DateTime(dt_format='iso8601'),
         'ask_text': rfields.String,
@@ -502,18 +496,13 @@ class Question(Resource):
 
     @marshal_with(ask_info)
     def get(self, id):
-        abort_if_ask_doesnt_exist(id)
-        ask = Ask.query.get(id)
+        ask = Ask.query_with_answers().filter_by(id=id).first()
+        if ask is None:
+            abort(404, code=0, message='问题不存在')
         if g.teacher_user.is_employ(ask.school_id) is False:
             abort(401, message='你不是这里的老师')
-        imgs = []
-        img_ids = ask.img_ids
-        if img_ids:
-            img_list = img_ids.rsplit(',')
-            for i in img_list:
-                img = Topicimage.query.get(i)
-                imgs.append(img.img_url)
-        ask.imgs = imgs
+        attach_imgs([ask], ask.answers)
+        attach_authors(ask.answers)
         return ask, 200
 
 
@@ -542,27 +531,21 @@ class TeacherAnswers(Resource):
     @use_args(answer_args)
     def post(self, args, ask_id):
         a_id = ask_id
-        abort_if_ask_doesnt_exist(a_id)
-        ask = Ask.query.get(a_id)
+        ask = abort_if_ask_doesnt_exist(a_id)
         sc_id = ask.school_id
         if g.teacher_user.is_employ(sc_id) is False:
             abort(401, message='没有权限')
-        imgs = []
         img_ids = args['img_ids']
-        if img_ids:
-            img_list = img_ids.rsplit(',')
-            for i in img_list:
-                img = Topicimage.query.get(i)
-                if img is None:
-                    abort(401, message='图片不存在')
-                imgs.append(img.img_url)
+        imgs, missing = resolve_img_ids(img_ids)
+        if missing:
+            abort(401, message='图片不存在')
         answer = Answer(
             teacher_id=g.teacher_user.id,
             answer_text=args['answer_text'],
             voice_url=args['voice_url'],
-            voice_duration=args['voice_duration'],
-            img_ids=img_ids
+            voice_duration=args['voice_duration']
         )
+        answer.set_images(img_ids)
         ask.answers.append(answer)
         db.session.add(answer)
         db.session.commit()
@@ -571,29 +554,19 @@ class TeacherAnswers(Resource):
 
     @marshal_with(answer_info)
     def get(self, ask_id):
-        abort_if_ask_doesnt_exist(ask_id)
-        answers = Ask.query.get(ask_id).answers
-        ask = Ask.query.get(ask_id)
+        ask = abort_if_ask_doesnt_exist(ask_id)
+        answers = ask.answers
         sc_id = ask.school_id
         if g.teacher_user.is_employ(sc_id) is False:
             abort(401, message='没有权限')
-        for answer in answers:
-            imgs = []
-            img_ids = answer.img_ids
-            if img_ids:
-                img_list = img_ids.rsplit(',')
-                for i in img_list:
-                    img = Topicimage.query.get(i)
-                    imgs.append(img.img_url)
-            answer.imgs = imgs
+        attach_imgs(answers)
         return answers, 200
 
     def delete(self, answer_id):
-        abort_if_answer_doesnt_exist(answer_id)
-        answer = Answer.query.get(answer_id)
+        answer = abort_if_answer_doesnt_exist(answer_id)
         if g.teacher_user.id != answer.teacher_id:
             abort(401, message='没有权限')
-        ask = Ask.query.get(answer.ask_id)
+        ask = get_entity(Ask, answer.ask_id)
         ask.answers.remove(answer)
         db.session.delete(answer)
         db.session.commit()
@@ -635,9 +608,10 @@ class SchoolCode(Resource):
             abort(403, code=0, message='邀请码无效')
         if g.teacher_user.is_employ(school_id):
             abort(403, code=0, message='你已经是这个学校老师')
-        school = School.query.get(school_id)
+        school = get_entity(School, school_id)
         g.teacher_user.schools.append(school)
         db.session.commit()
+        membership.invalidate_teachers(school.id)
         redis_store.delete(code)
         result = {
             'code': 1,
@@ -2,6 +2,7 @@ from flask import g
 from flask_restful import Resource, abort
 from flask_httpauth import HTTPBasicAuth
 from ..models import Student
+from ..units import refresh_tokens
 from . import student_api, student_api_bp
 
 auth = HTTPBasicAuth()
@@ -10,10 +11,12 @@ auth = HTTPBasicAuth()
 @auth.verify_password
 def verify_password(username_or_token, password):
     student_user = Student.verify_auth_token(username_or_token)
+    g.password_auth = False
     if not student_user:
         student_user = Student.query.filter_by(telephone=username_or_token).first()
         if not student_user or not student_user.verify_password(password):
             return False
+        g.password_auth = True
     g.student_user = student_user
     return True
 
@@ -32,7 +35,22 @@ def auth_error():
 class GetToken(Resource):
     def get(self):
         token = g.student_user.generate_auth_token(600)
-        return {'code': 1, 'token': token, 'expiration': 600}
+        result = {
+            'code': 1,
+            'token': token,
+            'expiration': 600
+        }
+        # 只有用密码登录时才发刷新 token，访问 token 不能用来续出新的会话
+        if g.password_auth:
+            result['refresh_token'] = refresh_tokens.issue('student', g.student_user.id)
+        return result
+
+
+class Sessions(Resource):
+    def delete(self):
+        revoked = refresh_tokens.revoke_all('student', g.student_user.id)
+        return {'code': 1, 'revoked': revoked}
 
 
 student_api.add_resource(GetToken, '/token')
+student_api.add_resource(Sessions, '/sessions')
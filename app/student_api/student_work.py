@@ -3,41 +3,42 @@ from flask import g, url_for
 from flask_restful import Resource, marshal_with, abort, fields as rfields
 from webargs import fields, validate
 from webargs.flaskparser import use_args
-from ..models import Student, School, Ask, Answer, Topicimage, SchoolStudent, Teacher
+from ..models import Student, School, Ask, Answer, SchoolStudent, SchoolCounter
+from ..units.topicimgs import attach_imgs, resolve_img_ids
+from ..units.paging import KeysetPage, counted_paginate
+from ..units.authors import attach_authors
+from ..units import quota
+from ..units.loader import get_entity
 from .. import db
 from . import student_api
 
 
 def abort_if_school_doesnt_exist(id):
-    if School.query.get(id) is None:
+    entity = get_entity(School, id)
+    if entity is None:
         abort(404, code=0, message='学校不存在')
+    return entity
 
 
 def abort_if_student_doesnt_exist(id):
-    if Student.query.get(id) is None:
+    entity = get_entity(Student, id)
+    if entity is None:
         abort(404, code=0, message='学生不存在')
+    return entity
 
 
 def abort_if_ask_doesnt_exist(id):
-    if Ask.query.get(id) is None:
+    entity = get_entity(Ask, id)
+    if entity is None:
         abort(404, code=0, message='问题不存在')
+    return entity
 
 
 def abort_if_answer_doesnt_exist(id):
-    if Answer.query.get(id) is None:
+    entity = get_entity(Answer, id)
+    if entity is None:
         abort(404, code=0, message='答案不存在')
-
-
-def imgidsToimgs(o):
-    imgs = []
-    img_ids = o.img_ids
-    if img_ids:
-        img_list = img_ids.rsplit(',')
-        for i in img_list:
-            img = Topicimage.query.get(i)
-            imgs.append(img.img_url)
-    o.imgs = imgs
-    return o
+    return entity
 
 
 class Questions(Resource):
@@ -52,8 +53,9 @@ class Questions(Resource):
     ask_list_args = {
         'school_id': fields.Int(required=True),
         'page': fields.Int(missing=1),
-        'per_page': fields.Int(missing=10),
-        'answered': fields.Int(validate=validate.OneOf([0, 1, 2]), missing=0)
+        'per_page': fields.Int(validate=validate.Range(min=1), missing=10),
+        'answered': fields.Int(validate=validate.OneOf([0, 1, 2]), missing=0),
+        'cursor': fields.Str(missing=None)
     }
 
     answer_info = {
@@ -103,6 +105,7 @@ class Questions(Resource):
         }),
         'prev': rfields.String(default=''),
         'next': rfields.String(default=''),
+        'next_cursor': rfields.String,
         'count': rfields.Integer
     }
 
@@ -113,17 +116,10 @@ class Questions(Resource):
         abort_if_school_doesnt_exist(s_id)
         if g.student_user.is_school_joined(s_id) is False:
             abort(403, code=0, message='不是这个学校/机构的学生')
-        if g.student_user.can_ask(s_id) is False:
-            abort(403, code=0, message='你的提问次数已经用完了')
-        imgs = []
         img_ids = args['img_ids']
-        if img_ids:
-            img_list = img_ids.rsplit(',')
-            for i in img_list:
-                img = Topicimage.query.get(i)
-                if img is None:
-                    abort(401, message='图片不存在')
-                imgs.append(img.img_url)
+        imgs, missing = resolve_img_ids(img_ids)
+        if missing:
+            abort(401, message='图片不存在')
         if not(args['ask_text'] or args['voice_url'] or img_ids):
             abort(400, code=0, message='没有提问任何问题')
         ask = Ask(
@@ -131,22 +127,22 @@ class Questions(Resource):
             student_id=g.student_user.id,
             ask_text=args['ask_text'],
             voice_url=args['voice_url'],
-            voice_duration=args['voice_duration'],
-            img_ids=img_ids
+            voice_duration=args['voice_duration']
         )
+        ask.set_images(img_ids)
+        # 数据库模式下扣减次数与写入问题在同一事务
+        consumed = quota.consume_ask(s_id, g.student_user.id)
+        if not consumed:
+            db.session.rollback()
+            abort(403, code=0, message='你的提问次数已经用完了')
         db.session.add(ask)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            quota.refund_ask(s_id, g.student_user.id, consumed)
+            raise
         ask.imgs = imgs
-        member_info = SchoolStudent.query.filter_by(
-            school_id=s_id,
-            student_id=g.student_user.id
-        ).first()
-        if member_info.vip_times > 0:
-            member_info.vip_times -= 1
-        else:
-            member_info.nomal_times -= 1
-        db.session.add(member_info)
-        db.session.commit()
         result = {
             'code': 1,
             'ask': ask
@@ -163,59 +159,52 @@ class Questions(Resource):
         abort_if_school_doesnt_exist(s_id)
         if g.student_user.is_school_joined(s_id) is False:
             abort(403, code=0, message='不是这个学校/机构的学生')
-        # 全部
-        if answered == 0:
-            pagination = Ask.query.filter_by(
-                school_id=s_id,
-                student_id=g.student_user.id
-            ).order_by(Ask.id.desc()).paginate(
-                page=page, per_page=per_page, error_out=True
-            )
+        query = Ask.query.filter_by(
+            school_id=s_id,
+            student_id=g.student_user.id
+        )
+        be_answered = None
         # 已回答
         if answered == 1:
-            pagination = Ask.query.filter_by(
-                school_id=s_id,
-                student_id=g.student_user.id,
-                be_answered=True
-            ).order_by(Ask.id.desc()).paginate(
-                page=page, per_page=per_page, error_out=True
-            )
+            be_answered = True
         # 未回答
         if answered == 2:
-            pagination = Ask.query.filter_by(
-                school_id=s_id,
-                student_id=g.student_user.id,
-                be_answered=False
-            ).order_by(Ask.id.desc()).paginate(
-                page=page, per_page=per_page, error_out=True
-            )
-        asks = pagination.items
+            be_answered = False
+        if be_answered is not None:
+            query = query.filter_by(be_answered=be_answered)
+        count = SchoolCounter.fetch(s_id, g.student_user.id).asks(be_answered)
         prev = None
-        if pagination.has_prev:
-            prev = url_for('student_api.asks', s_id=s_id, page=page-1, per_page=per_page)
         next = None
-        if pagination.has_next:
-            next = url_for('student_api.asks', s_id=s_id, page=page+1, per_page=per_page)
-
-        for ask in asks:
-            ask = imgidsToimgs(ask)
-            '''
-            imgs = []
-            img_ids = ask.img_ids
-            if img_ids:
-                img_list = img_ids.rsplit(',')
-                for i in img_list:
-                    img = Topicimage.query.get(i)
-                    imgs.append(img.img_url)
-            ask.imgs = imgs
-            '''
+        next_cursor = None
+        # 游标模式：不做 OFFSET 扫描
+        if args['cursor'] is not None:
+            keyset = KeysetPage(query, Ask.id, args['cursor'], per_page)
+            asks = keyset.items
+            next_cursor = keyset.next_cursor
+            if keyset.has_next:
+                next = url_for(
+                    'student_api.asks', school_id=s_id, answered=answered,
+                    cursor=next_cursor, per_page=per_page
+                )
+        else:
+            pagination = counted_paginate(
+                query.order_by(Ask.id.desc()), page, per_page, count
+            )
+            asks = pagination.items
+            if pagination.has_prev:
+                prev = url_for('student_api.asks', s_id=s_id, page=page-1, per_page=per_page)
+            if pagination.has_next:
+                next = url_for('student_api.asks', s_id=s_id, page=page+1, per_page=per_page)
+
+        attach_imgs(asks)
 
         result = {
             'code': 1,
             'asks': asks,
             'prev': prev,
             'next': next,
-            'count': pagination.total
+            'next_cursor': next_cursor,
+            'count': count
         }
         return result, 200
 
@@ -262,23 +251,13 @@ class Question(Resource):
 
     @marshal_with(ask_info)
     def get(self, id):
-        abort_if_ask_doesnt_exist(id)
-        ask = Ask.query.get(id)
+        ask = Ask.query_with_answers().filter_by(id=id).first()
+        if ask is None:
+            abort(404, code=0, message='问题不存在')
         if g.student_user.id != ask.student_id:
             abort(401, code=0, message='没有权限')
-        ask = imgidsToimgs(ask)
-        for answer in ask.answers:
-            answer = imgidsToimgs(answer)
-            teacher_id = answer.teacher_id
-            if teacher_id:
-                teacher = Teacher.query.get(teacher_id)
-                answer.teacher_nickname = teacher.nickname
-                answer.teacher_imgurl = teacher.imgurl
-            student_id = answer.student_id
-            if student_id:
-                student = Student.query.get(student_id)
-                answer.student_nickname = student.nickname
-                answer.student_imgurl = student.imgurl
+        attach_imgs([ask], ask.answers)
+        attach_authors(ask.answers)
         result = {
             'code': 1,
             'ask': ask
@@ -286,8 +265,7 @@ class Question(Resource):
         return result, 200
 
     def delete(self, id):
-        abort_if_ask_doesnt_exist(id)
-        ask = Ask.query.get(id)
+        ask = abort_if_ask_doesnt_exist(id)
         if g.student_user.id != ask.student_id:
             abort(401, code=0, message='没有权限')
         db.session.delete(ask)
@@ -319,29 +297,23 @@ class StudentAnswers(Resource):
     @use_args(answer_args)
     def post(self, args, ask_id):
         a_id = ask_id
-        abort_if_ask_doesnt_exist(a_id)
-        ask = Ask.query.get(a_id)
+        ask = abort_if_ask_doesnt_exist(a_id)
         st_id = ask.student_id
         if g.student_user.id != st_id:
             abort(401, code=0, message='没有权限')
         if ask.be_answered is False:
             abort(401, code=0, message='老师没有回答')
-        imgs = []
         img_ids = args['img_ids']
-        if img_ids:
-            img_list = img_ids.rsplit(',')
-            for i in img_list:
-                img = Topicimage.query.get(i)
-                if img is None:
-                    abort(404, code=0, message='图片不存在')
-                imgs.append(img.img_url)
+        imgs, missing = resolve_img_ids(img_ids)
+        if missing:
+            abort(404, code=0, message='图片不存在')
         answer = Answer(
             student_id=g.student_user.id,
             answer_text=args['answer_text'],
             voice_url=args['voice_url'],
-            voice_duration=args['voice_duration'],
-            img_ids=img_ids
+            voice_duration=args['voice_duration']
         )
+        answer.set_images(img_ids)
         ask.answers.append(answer)
         db.session.add(answer)
         db.session.commit()
@@ -350,30 +322,19 @@ class StudentAnswers(Resource):
 
     @marshal_with(answer_info)
     def get(self, ask_id):
-        abort_if_ask_doesnt_exist(ask_id)
-        answers = Ask.query.get(ask_id).answers
-        ask = Ask.query.get(ask_id)
+        ask = abort_if_ask_doesnt_exist(ask_id)
+        answers = ask.answers
         st_id = ask.student_id
         if g.student_user.id != st_id:
             abort(401, code=0, message='没有权限')
-        for answer in answers:
-            answer = imgidsToimgs(answer)
-            '''imgs = []
-            img_ids = answer.img_ids
-            if img_ids:
-                img_list = img_ids.rsplit(',') 
-                for i in img_list:
-                    img = Topicimage.query.get(i)
-                    imgs.append(img.img_url)
-            answer.imgs = imgs'''
+        attach_imgs(answers)
         return answers, 200
 
     def delete(self, answer_id):
-        abort_if_answer_doesnt_exist(answer_id)
-        answer = Answer.query.get(answer_id)
+        answer = abort_if_answer_doesnt_exist(answer_id)
         if g.student_user.id != answer.student_id:
             abort(401, code=0, message='没有权限')
-        ask = Ask.query.get(answer.ask_id)
+        ask = get_entity(Ask, answer.ask_id)
         ask.answers.remove(answer)
         db.session.delete(answer)
         db.session.commit()
@@ -396,8 +357,7 @@ class AnswerGrate(Resource):
     }
 
     def get(self, ask_id):
-        abort_if_ask_doesnt_exist(ask_id)
-        ask = Ask.query.get(ask_id)
+        ask = abort_if_ask_doesnt_exist(ask_id)
         if g.student_user.id != ask.student_id:
             abort(403, code=0, message='没有权限')
         grate_value = ask.answer_grate
@@ -405,8 +365,7 @@ class AnswerGrate(Resource):
 
     @use_args(grate_args)
     def put(self, args, ask_id):
-        abort_if_ask_doesnt_exist(ask_id)
-        ask = Ask.query.get(ask_id)
+        ask = abort_if_ask_doesnt_exist(ask_id)
         if g.student_user.id != ask.student_id:
             abort(403, code=0, message='没有权限')
         if not ask.be_answered:
@@ -435,10 +394,9 @@ class SchoolInfo(Resource):
 
     @marshal_with(school_info)
     def get(self, school_id):
-        abort_if_school_doesnt_exist(school_id)
+        school = abort_if_school_doesnt_exist(school_id)
         if g.student_user.is_school_joined(school_id) is False:
             abort(403, code=0, message='不是这个学校/机构的学生')
-        school = School.query.get(school_id)
         course = school.courses.all()[0]
         result = {
             'code': 1,
@@ -472,9 +430,8 @@ class StudentInSchoolInfo(Resource):
     @use_args(school_args)
     def get(self, args, student_id):
         school_id = args['school_id']
-        abort_if_student_doesnt_exist(student_id)
+        student = abort_if_student_doesnt_exist(student_id)
         abort_if_school_doesnt_exist(school_id)
-        student = Student.query.get(student_id)
         if student.is_school_joined(school_id) is False:
             abort(403, code=0, message='不是这个学校/机构的学生')
         member_info = SchoolStudent.query.filter_by(
@@ -482,8 +439,8 @@ class StudentInSchoolInfo(Resource):
             student_id=student_id
         ).first()
         vip_expire = member_info.vip_expire
-        vip_times = member_info.vip_times
-        nomal_times = member_info.nomal_times
+        vip_times, nomal_times = quota.times(member_info)
+        left_nomal_times = nomal_times
         real_times = nomal_times
         vip_status = False
         if member_info.vip_expire > datetime.utcnow():
@@ -491,10 +448,7 @@ class StudentInSchoolInfo(Resource):
             nomal_times = vip_times + nomal_times
             if vip_expire == -1:
                 real_times = -1
-        asks_count = db.session.query(Ask).filter_by(
-            school_id=school_id,
-            student_id=student_id
-        ).count()
+        asks_count = SchoolCounter.fetch(school_id, student_id).asks()
         result = {
             'code': 1,
             'student_id': student_id,
@@ -502,8 +456,8 @@ class StudentInSchoolInfo(Resource):
             'imgurl': student.imgurl,
             'vip_expire': vip_expire,
             'vip_status': vip_status,
-            'vip_times': member_info.vip_times,
-            'nomal_times': member_info.nomal_times,
+            'vip_times': vip_times,
+            'nomal_times': left_nomal_times,
             'real_times': real_times,
             'asks_count': asks_count,
             'timestamp': member_info.timestamp
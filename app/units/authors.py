@@ -0,0 +1,26 @@
+from ..models import Teacher, Student
+
+
+# 按 id 批量取出用户，返回 {id: user}
+def load_users(model, ids):
+    ids = set(i for i in ids if i)
+    if not ids:
+        return {}
+    return {u.id: u for u in model.query.filter(model.id.in_(ids)).all()}
+
+
+def attach_authors(answers):
+    """为一组答案填充老师/学生的昵称和头像，老师、学生各一次查询。"""
+    answers = list(answers)
+    teachers = load_users(Teacher, [a.teacher_id for a in answers])
+    students = load_users(Student, [a.student_id for a in answers])
+    for answer in answers:
+        teacher = teachers.get(answer.teacher_id)
+        if teacher is not None:
+            answer.teacher_nickname = teacher.nickname
+            answer.teacher_imgurl = teacher.imgurl
+        student = students.get(answer.student_id)
+        if student is not None:
+            answer.student_nickname = student.nickname
+            answer.student_imgurl = student.imgurl
+    return answers
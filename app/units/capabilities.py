@@ -0,0 +1,97 @@
+"""token 中携带的学校权限。
+
+老师 token 带所在学校和担任管理员的学校，学生 token 带已加入的学校，
+另带格式版本 v 与用户的权限版本 ver。is_employ / is_teacher_admin /
+is_school_joined 先看 token，命中即返回，未命中再查成员缓存或数据库，
+所以 token 只会多给出"是"，不会误判为"否"。
+
+成员关系变化提交后递增 Redis 中该用户的权限版本（capver:<角色>:<id>），
+ver 较旧的 token 不再使用其中的权限，直到重新获取 token。
+读不到 Redis 时 token 不带权限，也不采信已有 token 中的权限。
+"""
+from collections import namedtuple
+from flask import current_app
+from redis.exceptions import RedisError
+from .. import db, redis_store
+
+TOKEN_FORMAT = 2
+VERSION_KEY = 'capver:%s:%s'
+
+Capabilities = namedtuple('Capabilities', ['schools', 'admin_schools'])
+
+
+def current_version(role, user_id):
+    """返回权限版本，Redis 不可用时返回 None。"""
+    try:
+        value = redis_store.get(VERSION_KEY % (role, user_id))
+    except RedisError as e:
+        current_app.logger.warning('capability version unavailable: %s', e)
+        return None
+    return int(value or 0)
+
+
+def bump(role, user_id):
+    try:
+        redis_store.incr(VERSION_KEY % (role, user_id))
+    except RedisError as e:
+        current_app.logger.error('capability version bump failed %s:%s: %s', role, user_id, e)
+
+
+def claims(user, role):
+    """生成 token 时附加的权限声明。"""
+    from ..models import School, SchoolStudent, employs
+    version = current_version(role, user.id)
+    if version is None:
+        return {}
+    # 先读版本再读成员，期间的变化会让这个 token 立即过时
+    if role == 'student':
+        schools = [row[0] for row in db.session.query(SchoolStudent.school_id).filter(
+            SchoolStudent.student_id == user.id)]
+        admin_schools = []
+    else:
+        rows = db.session.query(School.id, School.admin).join(
+            employs, employs.c.school_id == School.id
+        ).filter(employs.c.teacher_id == user.id).all()
+        schools = [school_id for school_id, admin in rows]
+        admin_schools = [school_id for school_id, admin in rows
+                         if user.telephone and admin == user.telephone]
+    return {
+        'v': TOKEN_FORMAT,
+        'ver': version,
+        'schools': sorted(schools),
+        'admin_schools': sorted(admin_schools)
+    }
+
+
+def raw_claims(data):
+    """从 token 内容中取出权限声明，旧格式返回 None。"""
+    if data.get('v') != TOKEN_FORMAT:
+        return None
+    return (data['ver'], tuple(data.get('schools', ())), tuple(data.get('admin_schools', ())))
+
+
+def verify(role, user_id, raw):
+    """权限版本仍是最新时返回 Capabilities，否则返回 None。"""
+    if raw is None:
+        return None
+    version, schools, admin_schools = raw
+    if current_version(role, user_id) != version:
+        return None
+    return Capabilities(frozenset(schools), frozenset(admin_schools))
+
+
+def has_school(user, school_id):
+    caps = getattr(user, 'capabilities', None)
+    return caps is not None and _int(school_id) in caps.schools
+
+
+def is_school_admin(user, school_id):
+    caps = getattr(user, 'capabilities', None)
+    return caps is not None and _int(school_id) in caps.admin_schools
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
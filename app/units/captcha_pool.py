@@ -0,0 +1,113 @@
+"""预先生成的图片验证码池。
+
+后台（flask fill_captchas）按 CAPTCHA_POOL_REFILL_RATE 张/秒把池补到
+CAPTCHA_POOL_SIZE 张：每张是一条 hash captcha:{<uuid>}（img 为 JPEG，
+code 为答案），过期时间 CAPTCHA_POOL_TTL，uuid 依次放进列表 captcha:pool。
+
+取用时弹出 uuid，再由 Lua 脚本读出图片、删除条目并把答案以该 uuid
+为键写入（与 ImgCode 相同，580 秒），请求中不出图也不写盘。
+池空时当场生成一张，记为 underflow。
+脚本只访问 KEYS 中声明的键；条目键用 {uuid} 作 hash tag，
+与答案键落在同一个集群槽。
+"""
+import io
+import uuid
+from flask import current_app
+from .. import redis_store
+from . import vercode
+
+POOL_KEY = 'captcha:pool'
+ENTRY_KEY = 'captcha:{%s}'
+STATS_KEY = 'captcha:stats'
+CODE_TTL = 580
+
+# KEYS: 条目, 答案  ARGV: 答案过期时间
+# 返回图片；条目已过期返回 nil
+CLAIM_SCRIPT = """
+local entry = redis.call('HMGET', KEYS[1], 'img', 'code')
+if not entry[1] then
+    return nil
+end
+redis.call('DEL', KEYS[1])
+redis.call('SETEX', KEYS[2], ARGV[1], entry[2])
+return entry[1]
+"""
+
+
+def render():
+    """生成一张验证码，返回 (JPEG 字节, 答案)。"""
+    image, code = vercode.VerCodeImg().render()
+    buf = io.BytesIO()
+    image.save(buf, 'jpeg')
+    return buf.getvalue(), code
+
+
+def take():
+    """取一张验证码，返回 (uuid, JPEG 字节)，答案已写入 Redis。"""
+    claim = redis_store.register_script(CLAIM_SCRIPT)
+    auuid = img = None
+    expired = 0
+    while img is None:
+        popped = redis_store.lpop(POOL_KEY)
+        if popped is None:
+            break
+        auuid = popped.decode('utf-8')
+        img = claim(keys=[ENTRY_KEY % auuid, auuid], args=[CODE_TTL])
+        if img is None:
+            expired += 1
+    pipe = redis_store.pipeline()
+    if expired:
+        pipe.hincrby(STATS_KEY, 'expired', expired)
+    if img is None:
+        img, code = render()
+        auuid = str(uuid.uuid1())
+        pipe.setex(auuid, CODE_TTL, code)
+        pipe.hincrby(STATS_KEY, 'underflow', 1)
+    else:
+        pipe.hincrby(STATS_KEY, 'served', 1)
+    pipe.execute()
+    return auuid, img
+
+
+def prune():
+    """去掉池头部已过期的 uuid，返回去掉的数量。"""
+    pruned = 0
+    while True:
+        head = redis_store.lindex(POOL_KEY, 0)
+        if head is None or redis_store.exists(ENTRY_KEY % head.decode('utf-8')):
+            break
+        # 只删这个值，期间被别的请求取走时删除数为 0
+        pruned += redis_store.execute_command('LREM', POOL_KEY, 1, head)
+    if pruned:
+        redis_store.hincrby(STATS_KEY, 'expired', pruned)
+    return pruned
+
+
+def fill(limit=None):
+    """补充验证码池，最多生成 limit 张，返回生成的数量。"""
+    prune()
+    missing = current_app.config['CAPTCHA_POOL_SIZE'] - redis_store.llen(POOL_KEY)
+    if limit is not None:
+        missing = min(missing, limit)
+    ttl = current_app.config['CAPTCHA_POOL_TTL']
+    pipe = redis_store.pipeline(transaction=False)
+    for i in range(max(missing, 0)):
+        img, code = render()
+        auuid = str(uuid.uuid1())
+        pipe.hmset(ENTRY_KEY % auuid, {'img': img, 'code': code})
+        pipe.expire(ENTRY_KEY % auuid, ttl)
+        pipe.rpush(POOL_KEY, auuid)
+    if missing > 0:
+        pipe.hincrby(STATS_KEY, 'rendered', missing)
+        pipe.execute()
+    return max(missing, 0)
+
+
+def stats():
+    counters = dict(
+        (k.decode('utf-8'), int(v)) for k, v in redis_store.hgetall(STATS_KEY).items()
+    )
+    result = {'depth': redis_store.llen(POOL_KEY), 'size': current_app.config['CAPTCHA_POOL_SIZE']}
+    for name in ('rendered', 'served', 'underflow', 'expired'):
+        result[name] = counters.get(name, 0)
+    return result
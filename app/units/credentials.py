@@ -0,0 +1,83 @@
+"""密码验证结果缓存。
+
+用 HTTP Basic 每次都带手机号和密码的客户端会让每个请求都跑一遍
+check_password_hash。验证成功后以 HMAC(SECRET_KEY, 表名:id:密码:哈希)
+为键记下结果，CREDENTIAL_CACHE_TTL 内同样的凭据直接通过；
+缓存中只有摘要，不保存明文。哈希变化后键自然失效，
+password setter 还会主动清除该用户的条目。
+
+未命中缓存且验证成功时，若哈希不符合当前 PASSWORD_HASH 策略则顺带重算。
+"""
+import hmac
+import hashlib
+from flask import current_app, has_app_context
+from sqlalchemy.orm.attributes import set_committed_value
+from .. import db
+from .ttlcache import TTLCache
+from .passwords import check_password, hash_password, needs_rehash
+
+
+def credential_cache():
+    app = current_app._get_current_object()
+    cache = app.extensions.get('credential_cache')
+    if cache is None:
+        cache = app.extensions['credential_cache'] = TTLCache(
+            app.config['CREDENTIAL_CACHE_SIZE'],
+            app.config['CREDENTIAL_CACHE_TTL']
+        )
+    return cache
+
+
+def _owner(user):
+    return (user.__tablename__, user.id)
+
+
+def _digest(user, password):
+    raw = '%s:%s:%s:%s' % (user.__tablename__, user.id, password, user.password_hash)
+    key = current_app.config['SECRET_KEY'].encode('utf-8')
+    return hmac.new(key, raw.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def verify_password(user, password):
+    """与 check_password(user.password_hash, password) 结果相同。"""
+    if user.id is None or not user.password_hash:
+        return check_password(user.password_hash, password)
+    cache = credential_cache()
+    digest = _digest(user, password)
+    if cache.get(digest) is not None:
+        return True
+    if not check_password(user.password_hash, password):
+        return False
+    if needs_rehash(user.password_hash):
+        rehash(user, password)
+        digest = _digest(user, password)
+    cache.set(digest, _owner(user))
+    return True
+
+
+def rehash(user, password):
+    """按当前策略重算哈希，用独立连接只更新这一列并提交，不提交请求会话中的其他修改。
+
+    哈希已被别处改过时不覆盖；失败时保留旧哈希。
+    """
+    old_hash = user.password_hash
+    new_hash = hash_password(password)
+    table = user.__table__
+    try:
+        with db.engine.begin() as conn:
+            updated = conn.execute(table.update().where(
+                table.c.id == user.id
+            ).where(
+                table.c.password_hash == old_hash
+            ).values(password_hash=new_hash)).rowcount
+    except Exception as e:
+        current_app.logger.warning('password rehash failed for %s %s: %s', user.__tablename__, user.id, e)
+        return
+    if updated:
+        set_committed_value(user, 'password_hash', new_hash)
+
+
+def forget_password(user):
+    if has_app_context() and user.id is not None:
+        owner = _owner(user)
+        credential_cache().discard_where(lambda value: value == owner)
@@ -0,0 +1,58 @@
+"""清理 ImgCode 写入 IMGCODE_FILE 的验证码图片。
+
+答案在 Redis 中 580 秒后过期，图片却一直留在目录里。ImgCode 每写一张
+就把文件名按生成时间记入有序集合 imgcode:files，sweep 按分数取出超过
+IMGCODE_MAX_AGE 的文件成批删除，不需要列出目录。
+索引建立之前留下的旧文件用 scan 按修改时间清理一次。
+"""
+import os
+import time
+from flask import current_app
+from .. import redis_store
+
+INDEX_KEY = 'imgcode:files'
+
+
+def track(filename):
+    """记录新生成的验证码图片。"""
+    # redis-py 各版本 zadd 参数不同，直接发命令
+    redis_store.execute_command('ZADD', INDEX_KEY, time.time(), filename)
+
+
+def _remove(folder, filename):
+    try:
+        os.remove(os.path.join(folder, filename))
+    except FileNotFoundError:
+        pass
+
+
+def sweep(batch=1000, now=None):
+    """删除过期的验证码图片，返回删除的数量。"""
+    folder = current_app.config['IMGCODE_FILE']
+    cutoff = (now or time.time()) - current_app.config['IMGCODE_MAX_AGE']
+    removed = 0
+    while True:
+        names = redis_store.zrangebyscore(INDEX_KEY, '-inf', cutoff, 0, batch)
+        if not names:
+            return removed
+        for name in names:
+            _remove(folder, name.decode('utf-8'))
+        redis_store.zrem(INDEX_KEY, *names)
+        removed += len(names)
+
+
+def scan(now=None):
+    """遍历一次目录，删除修改时间过期的 .jpg，返回删除的数量。"""
+    folder = current_app.config['IMGCODE_FILE']
+    cutoff = (now or time.time()) - current_app.config['IMGCODE_MAX_AGE']
+    removed = 0
+    if not os.path.isdir(folder):
+        return removed
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.jpg') or not entry.is_file():
+                continue
+            if entry.stat().st_mtime < cutoff:
+                _remove(folder, entry.name)
+                removed += 1
+    return removed
@@ -0,0 +1,60 @@
+"""请求内实体缓存。
+
+同一请求中按 (模型, 主键) 只取一次，包括不存在的结果，
+abort_if_* 与模型方法都经由 get_entity 取学校、学生、老师等。
+请求之外（命令行、shell）不缓存。
+"""
+from flask import g, has_request_context, current_app
+
+_MISSING = object()
+
+
+def _cache():
+    if '_entities' not in g:
+        g._entities = {}
+        g._entity_stats = {'hit': 0, 'miss': 0}
+    return g._entities
+
+
+def get_entity(model, id):
+    """按主键取实体，不存在时返回 None。"""
+    if not has_request_context():
+        return model.query.get(id)
+    try:
+        key = (model.__name__, int(id))
+    except (TypeError, ValueError):
+        return model.query.get(id)
+    cache = _cache()
+    entity = cache.get(key, _MISSING)
+    if entity is _MISSING:
+        g._entity_stats['miss'] += 1
+        entity = model.query.get(id)
+        cache[key] = entity
+    else:
+        g._entity_stats['hit'] += 1
+    return entity
+
+
+def forget_entity(model, id):
+    """实体被删除或新建后丢弃缓存。"""
+    if has_request_context() and '_entities' in g:
+        g._entities.pop((model.__name__, int(id)), None)
+
+
+def entity_stats():
+    """当前请求的命中/未命中次数。"""
+    if has_request_context() and '_entity_stats' in g:
+        return dict(g._entity_stats)
+    return {'hit': 0, 'miss': 0}
+
+
+def reset_entities():
+    g.pop('_entities', None)
+    g.pop('_entity_stats', None)
+
+
+def log_entity_stats(response):
+    stats = entity_stats()
+    if stats['hit'] or stats['miss']:
+        current_app.logger.debug('entity loader hit=%d miss=%d', stats['hit'], stats['miss'])
+    return response
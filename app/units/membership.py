@@ -0,0 +1,100 @@
+"""学校成员缓存。
+
+每个学校在 Redis 中各有一个学生 id 集合和老师 id 集合，
+is_school_joined / is_employ 只查集合，集合不存在时整体从数据库重建。
+成员变化后调用 invalidate_* 删除集合；集合中查不到时再用数据库确认，
+刚加入的成员不会被旧集合拒绝。MEMBERSHIP_CACHE_TTL 为 0 或 Redis
+不可用时直接查数据库。
+"""
+from flask import current_app
+from redis.exceptions import RedisError
+from .. import db, redis_store
+from ..models import SchoolStudent, employs
+
+MEMBERS_KEY = 'members:%s:%s'
+STUDENTS = 'students'
+TEACHERS = 'teachers'
+# 占位成员，区分已加载的空集合和未加载
+LOADED = 0
+
+
+def _key(kind, school_id):
+    return MEMBERS_KEY % (int(school_id), kind)
+
+
+def _ids_query(kind, school_id):
+    if kind == STUDENTS:
+        return db.session.query(SchoolStudent.student_id).filter(
+            SchoolStudent.school_id == school_id)
+    return db.session.query(employs.c.teacher_id).filter(
+        employs.c.school_id == school_id)
+
+
+def _db_has(kind, school_id, member_id):
+    query = _ids_query(kind, school_id)
+    if kind == STUDENTS:
+        query = query.filter(SchoolStudent.student_id == member_id)
+    else:
+        query = query.filter(employs.c.teacher_id == member_id)
+    return query.first() is not None
+
+
+def _load(kind, school_id):
+    ids = [row[0] for row in _ids_query(kind, school_id)]
+    key = _key(kind, school_id)
+    pipe = redis_store.pipeline()
+    pipe.delete(key)
+    pipe.sadd(key, LOADED, *ids)
+    pipe.expire(key, current_app.config['MEMBERSHIP_CACHE_TTL'])
+    pipe.execute()
+    return ids
+
+
+def is_member(kind, school_id, member_id):
+    try:
+        school_id, member_id = int(school_id), int(member_id)
+    except (TypeError, ValueError):
+        return False
+    if not current_app.config['MEMBERSHIP_CACHE_TTL']:
+        return _db_has(kind, school_id, member_id)
+    key = _key(kind, school_id)
+    try:
+        pipe = redis_store.pipeline(transaction=False)
+        pipe.exists(key)
+        pipe.sismember(key, member_id)
+        loaded, found = pipe.execute()
+        if not loaded:
+            found = member_id in _load(kind, school_id)
+    except RedisError as e:
+        current_app.logger.warning('membership cache unavailable: %s', e)
+        return _db_has(kind, school_id, member_id)
+    if found:
+        return True
+    return _db_has(kind, school_id, member_id)
+
+
+def is_student(school_id, student_id):
+    return is_member(STUDENTS, school_id, student_id)
+
+
+def is_teacher(school_id, teacher_id):
+    return is_member(TEACHERS, school_id, teacher_id)
+
+
+def _invalidate(*keys):
+    try:
+        redis_store.delete(*keys)
+    except RedisError as e:
+        current_app.logger.error('membership cache invalidate failed %s: %s', keys, e)
+
+
+def invalidate_students(school_id):
+    _invalidate(_key(STUDENTS, school_id))
+
+
+def invalidate_teachers(school_id):
+    _invalidate(_key(TEACHERS, school_id))
+
+
+def invalidate_school(school_id):
+    _invalidate(_key(STUDENTS, school_id), _key(TEACHERS, school_id))
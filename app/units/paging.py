@@ -0,0 +1,51 @@
+import base64
+import json
+from flask import abort as http_abort
+from flask_restful import abort
+from flask_sqlalchemy import Pagination
+
+
+# 游标对客户端不透明，内容为最后一条记录的排序键
+def encode_cursor(last_id):
+    raw = json.dumps({'id': last_id}).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('utf-8').rstrip('=')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        return int(json.loads(raw.decode('utf-8'))['id'])
+    except (ValueError, TypeError, KeyError):
+        abort(400, code=0, message='cursor无效')
+
+
+class KeysetPage:
+    """按 id 倒序的游标分页，不做 OFFSET 扫描也不统计总数。
+
+    cursor 为空表示第一页，has_next 通过多取一条判断。
+    """
+
+    def __init__(self, query, id_column, cursor, per_page):
+        if per_page < 1:
+            abort(400, code=0, message='per_page无效')
+        last_id = decode_cursor(cursor)
+        if last_id is not None:
+            query = query.filter(id_column < last_id)
+        rows = query.order_by(id_column.desc()).limit(per_page + 1).all()
+        self.items = rows[:per_page]
+        self.has_next = len(rows) > per_page
+        self.next_cursor = None
+        if self.has_next:
+            self.next_cursor = encode_cursor(self.items[-1].id)
+
+
+def counted_paginate(query, page, per_page, total):
+    """与 Query.paginate(error_out=True) 相同，但总数由调用方给出，省掉 COUNT(*)。"""
+    if page < 1 or per_page < 0:
+        http_abort(404)
+    items = query.limit(per_page).offset((page - 1) * per_page).all()
+    if not items and page != 1:
+        http_abort(404)
+    return Pagination(query, page, per_page, total, items)
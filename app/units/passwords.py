@@ -0,0 +1,63 @@
+"""密码哈希策略。
+
+PASSWORD_HASH 指定新密码的算法与强度：
+    pbkdf2:sha256:50000   werkzeug 的 pbkdf2，最后一段为迭代次数
+    bcrypt:12             bcrypt，数字为 cost（log2 轮数）
+已有哈希不论哪种算法都能验证；与当前策略不一致的哈希在登录成功后重算。
+"""
+from flask import current_app, has_app_context
+from werkzeug.security import generate_password_hash, check_password_hash
+
+DEFAULT_POLICY = 'pbkdf2:sha256:50000'
+BCRYPT_PREFIXES = ('$2a$', '$2b$', '$2y$')
+
+
+def policy():
+    if has_app_context():
+        return current_app.config.get('PASSWORD_HASH') or DEFAULT_POLICY
+    return DEFAULT_POLICY
+
+
+def _bcrypt():
+    try:
+        import bcrypt
+    except ImportError:
+        raise RuntimeError('PASSWORD_HASH 使用 bcrypt 需要安装 bcrypt')
+    return bcrypt
+
+
+def _bcrypt_cost(setting):
+    return int(setting.split(':', 1)[1]) if ':' in setting else 12
+
+
+def hash_password(password, setting=None):
+    setting = setting or policy()
+    if setting.startswith('bcrypt'):
+        bcrypt = _bcrypt()
+        salt = bcrypt.gensalt(rounds=_bcrypt_cost(setting))
+        return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+    return generate_password_hash(password, method=setting)
+
+
+def check_password(pwhash, password):
+    if pwhash.startswith(BCRYPT_PREFIXES):
+        if password is None:
+            return False
+        return _bcrypt().checkpw(password.encode('utf-8'), pwhash.encode('utf-8'))
+    return check_password_hash(pwhash, password)
+
+
+def needs_rehash(pwhash, setting=None):
+    """哈希的算法或强度与当前策略不一致时返回 True。"""
+    setting = setting or policy()
+    if setting.startswith('bcrypt'):
+        if not pwhash.startswith(BCRYPT_PREFIXES):
+            return True
+        return int(pwhash.split('$')[2]) != _bcrypt_cost(setting)
+    if pwhash.startswith(BCRYPT_PREFIXES):
+        return True
+    method = pwhash.split('$', 1)[0]
+    if setting.startswith('pbkdf2') and setting.count(':') == 1:
+        # 未写迭代次数时使用 werkzeug 的默认值，只比较算法
+        return not method.startswith(setting + ':')
+    return method != setting
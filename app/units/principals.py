@@ -0,0 +1,125 @@
+"""token 到登录用户的进程内缓存。
+
+verify_auth_token 验证签名并取出用户后，把 (角色, token) 对应的
+Principal(id, role, telephone, disabled) 放进 LRU，过期时间取
+PRINCIPAL_CACHE_TTL 与 token 自身过期时间中较早者。命中时不再验签、
+不查数据库，直接把用户以未加载状态挂回 session，其余字段访问时才读取。
+
+token 中带 role 声明，只能用于对应角色；不带 role 的旧 token 在
+TOKEN_ACCEPT_UNTAGGED 打开期间仍按原方式接受。
+
+用户被删除、停用或更换手机号时由 models 中的 after_flush 监听清除；
+缓存只在本进程内，多进程部署时其他进程最多在 TTL 内继续使用旧数据。
+"""
+from collections import namedtuple
+from flask import current_app, has_app_context
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from .. import db
+from .loader import get_entity
+from .ttlcache import TTLCache
+from . import capabilities
+
+# caps 为 token 中的权限声明，见 capabilities
+Principal = namedtuple('Principal', ['id', 'role', 'telephone', 'disabled', 'caps'])
+
+
+class PrincipalCache(TTLCache):
+
+    def invalidate(self, role, user_id):
+        """清除某个用户的全部 token。"""
+        self.discard_where(lambda p: p.role == role and p.id == user_id)
+
+
+def principal_cache():
+    app = current_app._get_current_object()
+    cache = app.extensions.get('principal_cache')
+    if cache is None:
+        cache = app.extensions['principal_cache'] = PrincipalCache(
+            app.config['PRINCIPAL_CACHE_SIZE'],
+            app.config['PRINCIPAL_CACHE_TTL']
+        )
+    return cache
+
+
+def _attach(model, principal):
+    """按缓存的 Principal 得到 session 中的用户对象，不发出查询。"""
+    user = db.session.identity_map.get(identity_key(model, principal.id))
+    if user is not None:
+        return user
+    user = model(id=principal.id)
+    if hasattr(model, 'telephone'):
+        user.telephone = principal.telephone
+    if hasattr(model, 'disabled'):
+        user.disabled = principal.disabled
+    make_transient_to_detached(user)
+    db.session.add(user)
+    return user
+
+
+def _decode(token):
+    s = Serializer(current_app.config['SECRET_KEY'])
+    try:
+        return s.loads(token, return_header=True)
+    except Exception:
+        return None, None
+
+
+def _with_capabilities(user, principal):
+    user.capabilities = capabilities.verify(principal.role, principal.id, principal.caps)
+    return user
+
+
+def _load(model, role, token, data, header):
+    user = get_entity(model, data['id'])
+    if user is None:
+        return None
+    principal = Principal(
+        user.id,
+        role,
+        getattr(user, 'telephone', None),
+        bool(getattr(user, 'disabled', False)),
+        capabilities.raw_claims(data)
+    )
+    principal_cache().set((role, token), principal, header.get('exp'))
+    return _with_capabilities(user, principal)
+
+
+def load_token_user(model, role, token):
+    """验证 token 并返回用户，token 无效时返回 False，用户不存在时返回 None。"""
+    user, role = load_any_token_user(token, [(role, model)])
+    return user
+
+
+def load_any_token_user(token, roles):
+    """roles 为 [(角色, 模型)]，返回 (用户, 角色)。
+
+    只验签一次；带 role 的 token 只查对应的表，旧 token 按 roles 顺序查找。
+    """
+    cache = principal_cache()
+    for role, model in roles:
+        principal = cache.get((role, token))
+        if principal is not None:
+            return _with_capabilities(_attach(model, principal), principal), role
+    data, header = _decode(token)
+    if data is None:
+        return False, None
+    token_role = data.get('role')
+    if token_role is None:
+        if not current_app.config['TOKEN_ACCEPT_UNTAGGED']:
+            return False, None
+        for role, model in roles:
+            user = _load(model, role, token, data, header)
+            if user is not None:
+                return user, role
+        return None, None
+    for role, model in roles:
+        if role == token_role:
+            return _load(model, role, token, data, header), role
+    return False, None
+
+
+def invalidate_principal(role, user_id):
+    if has_app_context():
+        principal_cache().invalidate(role, user_id)
@@ -0,0 +1,227 @@
+"""提问次数账本。
+
+QUOTA_LEDGER 打开时，每个 (学校, 学生) 的剩余次数放在 Redis hash 中，
+由 Lua 脚本原子扣减，被扣减过的成员记入 quota:dirty，
+由 flask flush_quota 定期写回 school_student。
+老师修改次数时直接把新值写入账本并递增 rev，写回时跳过读取后被覆盖的成员。
+Redis 数据丢失时账本按数据库重新加载，最多损失一个写回周期内的扣减。
+关闭时直接在数据库中条件扣减（SchoolStudent.consume_ask）。
+"""
+import calendar
+from datetime import datetime
+from flask import current_app
+from .. import db, redis_store
+from ..models import SchoolStudent
+
+LEDGER_KEY = 'quota:%s:%s'
+DIRTY_KEY = 'quota:dirty'
+LEDGER_TTL = 7 * 24 * 3600
+
+# 扣减结果
+NO_QUOTA = 0
+VIP_TIMES = 1
+NOMAL_TIMES = 2
+VIP_UNLIMITED = 3
+DB_CONSUMED = 4
+
+# KEYS: 账本, 待写回集合  ARGV: 当前时间戳, 成员, TTL
+# 返回 -1 表示账本未加载
+CONSUME_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+local vip = tonumber(redis.call('HGET', KEYS[1], 'vip_times'))
+local nomal = tonumber(redis.call('HGET', KEYS[1], 'nomal_times'))
+local vip_valid = tonumber(redis.call('HGET', KEYS[1], 'vip_expire')) > tonumber(ARGV[1])
+local result = 0
+if vip_valid and vip > 0 then
+    redis.call('HINCRBY', KEYS[1], 'vip_times', -1)
+    result = 1
+elseif vip_valid and vip == -1 then
+    return 3
+elseif nomal > 0 then
+    redis.call('HINCRBY', KEYS[1], 'nomal_times', -1)
+    result = 2
+else
+    return 0
+end
+redis.call('SADD', KEYS[2], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return result
+"""
+
+# ARGV: vip_times, nomal_times, vip_expire, TTL, 是否覆盖
+# 覆盖时递增 rev，flush 据此发现快照之后被老师改过的成员
+LOAD_SCRIPT = """
+if ARGV[5] == '0' and redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HMSET', KEYS[1], 'vip_times', ARGV[1], 'nomal_times', ARGV[2], 'vip_expire', ARGV[3])
+if ARGV[5] == '1' then
+    redis.call('HINCRBY', KEYS[1], 'rev', 1)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+
+def ledger_enabled():
+    return bool(current_app.config.get('QUOTA_LEDGER'))
+
+
+def _key(school_id, student_id):
+    return LEDGER_KEY % (int(school_id), int(student_id))
+
+
+def _member(school_id, student_id):
+    return '%d:%d' % (int(school_id), int(student_id))
+
+
+def _timestamp(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
+def _now():
+    return _timestamp(datetime.utcnow())
+
+
+def _write(school_id, student_id, vip_times, nomal_times, vip_expire, overwrite):
+    redis_store.register_script(LOAD_SCRIPT)(
+        keys=[_key(school_id, student_id)],
+        args=[vip_times, nomal_times, _timestamp(vip_expire), LEDGER_TTL, 1 if overwrite else 0]
+    )
+
+
+def load(school_id, student_id):
+    """从数据库加载账本（已存在时不覆盖），不是该校学生时返回 False。"""
+    member_info = SchoolStudent.query.filter_by(
+        school_id=school_id,
+        student_id=student_id
+    ).first()
+    if member_info is None:
+        return False
+    _write(
+        school_id, student_id,
+        member_info.vip_times, member_info.nomal_times, member_info.vip_expire, False
+    )
+    return True
+
+
+def get(school_id, student_id):
+    """返回 {'vip_times', 'nomal_times', 'vip_expire'}，不是该校学生时返回 None。"""
+    key = _key(school_id, student_id)
+    values = redis_store.hgetall(key)
+    if not values:
+        if not load(school_id, student_id):
+            return None
+        values = redis_store.hgetall(key)
+    values = {k.decode('utf-8'): v.decode('utf-8') for k, v in values.items()}
+    return {
+        'vip_times': int(values['vip_times']),
+        'nomal_times': int(values['nomal_times']),
+        'vip_expire': float(values['vip_expire'])
+    }
+
+
+def times(member_info):
+    """返回 (vip_times, nomal_times)，账本模式下以账本为准。"""
+    if not ledger_enabled():
+        return member_info.vip_times, member_info.nomal_times
+    values = get(member_info.school_id, member_info.student_id)
+    return values['vip_times'], values['nomal_times']
+
+
+def can_ask(school_id, student_id):
+    values = get(school_id, student_id)
+    if values is None:
+        return False
+    if values['vip_expire'] > _now():
+        if values['vip_times'] == -1 or values['vip_times'] > 0:
+            return True
+    return values['nomal_times'] > 0
+
+
+def consume_ask(school_id, student_id):
+    """扣减一次提问次数，返回扣减结果，NO_QUOTA 表示次数不足。
+
+    数据库模式下扣减不提交，与问题写入同一事务。
+    """
+    if not ledger_enabled():
+        if SchoolStudent.consume_ask(school_id, student_id):
+            return DB_CONSUMED
+        return NO_QUOTA
+    consume = redis_store.register_script(CONSUME_SCRIPT)
+    keys = [_key(school_id, student_id), DIRTY_KEY]
+    args = [_now(), _member(school_id, student_id), LEDGER_TTL]
+    result = consume(keys=keys, args=args)
+    if result == -1:
+        if not load(school_id, student_id):
+            return NO_QUOTA
+        result = consume(keys=keys, args=args)
+    return max(int(result), NO_QUOTA)
+
+
+def refund_ask(school_id, student_id, consumed):
+    """问题写入失败时退回账本中已扣的次数，数据库模式由回滚处理。"""
+    if not ledger_enabled():
+        return
+    key = _key(school_id, student_id)
+    if consumed == VIP_TIMES:
+        redis_store.hincrby(key, 'vip_times', 1)
+    elif consumed == NOMAL_TIMES:
+        redis_store.hincrby(key, 'nomal_times', 1)
+
+
+def reset(school_id, student_id, vip_times, nomal_times, vip_expire):
+    """老师修改次数并提交后，用修改的值覆盖账本。
+
+    不从数据库重读：提交之后、覆盖之前可能有 flush 写回了旧快照，
+    重读会把旧值装进账本。覆盖后成员重新标脏，下次 flush 以新值为准。
+    """
+    if not ledger_enabled():
+        return
+    _write(school_id, student_id, vip_times, nomal_times, vip_expire, True)
+    redis_store.sadd(DIRTY_KEY, _member(school_id, student_id))
+
+
+def flush(batch=500):
+    """把账本中被扣减过的次数写回 school_student，返回写回的条数。"""
+    flushed = 0
+    table = SchoolStudent.__table__
+    while True:
+        members = []
+        for i in range(batch):
+            member = redis_store.spop(DIRTY_KEY)
+            if member is None:
+                break
+            members.append(member.decode('utf-8'))
+        if not members:
+            return flushed
+        keys = [LEDGER_KEY % tuple(member.split(':')) for member in members]
+        pipe = redis_store.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(key, 'vip_times', 'nomal_times', 'rev')
+        snapshot = pipe.execute()
+        try:
+            # 写库前再取一次 rev，快照之后被 reset 覆盖的成员已重新标脏，这里跳过
+            pipe = redis_store.pipeline(transaction=False)
+            for key in keys:
+                pipe.hget(key, 'rev')
+            revs = pipe.execute()
+            for member, (vip_times, nomal_times, rev), current in zip(members, snapshot, revs):
+                if vip_times is None or nomal_times is None or rev != current:
+                    continue
+                school_id, student_id = member.split(':')
+                db.session.execute(table.update().where(
+                    table.c.school_id == int(school_id)
+                ).where(
+                    table.c.student_id == int(student_id)
+                ).values(vip_times=int(vip_times), nomal_times=int(nomal_times)))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            redis_store.sadd(DIRTY_KEY, *members)
+            raise
+        flushed += len(members)
+        if len(members) < batch:
+            return flushed
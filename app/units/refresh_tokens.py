@@ -0,0 +1,95 @@
+"""刷新 token。
+
+登录（GetToken、微信登录）时除访问 token 外再发一个刷新 token
+"<sid>.<secret>"。Redis 中每个会话一条 hash（refresh:<sid>：role、uid、
+secret 的 sha256），每个用户一个会话集合（refresh:<role>:<uid>）。
+
+刷新时校验 secret 并换成新的（轮换），会话过期时间从此刻重新计算
+REFRESH_TOKEN_TTL（滑动过期）。已轮换掉的旧 secret 再次出现说明
+刷新 token 泄露，整个会话作废。
+"""
+import os
+import uuid
+import base64
+import hashlib
+from flask import current_app
+from .. import redis_store
+
+SESSION_KEY = 'refresh:%s'
+USER_SESSIONS_KEY = 'refresh:%s:%s'
+
+# KEYS: 会话  ARGV: 旧 secret 哈希, 新 secret 哈希, TTL
+# 返回 [role, uid]；会话不存在返回 nil；secret 不匹配时删除会话并返回 0
+ROTATE_SCRIPT = """
+local h = redis.call('HGET', KEYS[1], 'h')
+if not h then
+    return nil
+end
+if h ~= ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    return 0
+end
+redis.call('HSET', KEYS[1], 'h', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return redis.call('HMGET', KEYS[1], 'role', 'uid')
+"""
+
+
+def _hash(secret):
+    return hashlib.sha256(secret.encode('utf-8')).hexdigest()
+
+
+def _secret():
+    return base64.urlsafe_b64encode(os.urandom(24)).decode('utf-8')
+
+
+def _ttl():
+    return current_app.config['REFRESH_TOKEN_TTL']
+
+
+def issue(role, user_id):
+    """新建会话，返回刷新 token。"""
+    sid = uuid.uuid4().hex
+    secret = _secret()
+    user_key = USER_SESSIONS_KEY % (role, user_id)
+    pipe = redis_store.pipeline()
+    pipe.hmset(SESSION_KEY % sid, {'role': role, 'uid': user_id, 'h': _hash(secret)})
+    pipe.expire(SESSION_KEY % sid, _ttl())
+    pipe.sadd(user_key, sid)
+    pipe.expire(user_key, _ttl())
+    pipe.execute()
+    return '%s.%s' % (sid, secret)
+
+
+def rotate(refresh_token):
+    """校验并轮换刷新 token，成功返回 (role, user_id, 新刷新 token)，否则返回 None。"""
+    sid, _, secret = (refresh_token or '').partition('.')
+    if not sid or not secret:
+        return None
+    new_secret = _secret()
+    result = redis_store.register_script(ROTATE_SCRIPT)(
+        keys=[SESSION_KEY % sid],
+        args=[_hash(secret), _hash(new_secret), _ttl()]
+    )
+    if not result:
+        return None
+    role, user_id = [v.decode('utf-8') for v in result]
+    redis_store.expire(USER_SESSIONS_KEY % (role, user_id), _ttl())
+    return role, int(user_id), '%s.%s' % (sid, new_secret)
+
+
+def revoke(refresh_token):
+    sid = (refresh_token or '').partition('.')[0]
+    if sid:
+        redis_store.delete(SESSION_KEY % sid)
+
+
+def revoke_all(role, user_id):
+    """作废用户的全部会话，返回作废的数量。"""
+    user_key = USER_SESSIONS_KEY % (role, user_id)
+    sids = [sid.decode('utf-8') for sid in redis_store.smembers(user_key)]
+    if not sids:
+        return 0
+    removed = redis_store.delete(*[SESSION_KEY % sid for sid in sids])
+    redis_store.delete(user_key)
+    return removed
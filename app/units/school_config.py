@@ -0,0 +1,59 @@
+"""学校配置的进程内缓存。
+
+小程序登录和资料解密只需要学校的微信 appid/secret、是否停用以及首个
+课程的提问次数，上课前集中登录时每次都读 schools 表。这些字段放进
+LRU，SCHOOL_CONFIG_CACHE_TTL 秒后重新读取；学校或课程在本进程中
+修改时由 models 中的 after_flush 监听清除，其他进程最多在 TTL 内
+使用旧配置。
+"""
+from collections import namedtuple
+from flask import current_app, has_app_context
+from .. import db
+from .ttlcache import TTLCache
+
+# vip_times / nomal_times 取自学校的首个课程，没有课程时为 None
+SchoolConfig = namedtuple('SchoolConfig', ['id', 'wx_appid', 'wx_appsecret', 'disabled', 'vip_times', 'nomal_times'])
+
+
+def school_config_cache():
+    app = current_app._get_current_object()
+    cache = app.extensions.get('school_config_cache')
+    if cache is None:
+        cache = app.extensions['school_config_cache'] = TTLCache(
+            app.config['SCHOOL_CONFIG_CACHE_SIZE'],
+            app.config['SCHOOL_CONFIG_CACHE_TTL']
+        )
+    return cache
+
+
+def _load(school_id):
+    from ..models import School, Course
+    row = db.session.query(
+        School.id, School.wx_appid, School.wx_appsecret, School.disabled
+    ).filter(School.id == school_id).first()
+    if row is None:
+        return None
+    course = db.session.query(Course.vip_times, Course.nomal_times).filter(
+        Course.school_id == school_id).order_by(Course.id).first()
+    vip_times, nomal_times = course if course else (None, None)
+    return SchoolConfig(row.id, row.wx_appid, row.wx_appsecret, bool(row.disabled), vip_times, nomal_times)
+
+
+def get_school_config(school_id):
+    """返回 SchoolConfig，学校不存在时返回 None。"""
+    try:
+        school_id = int(school_id)
+    except (TypeError, ValueError):
+        return None
+    cache = school_config_cache()
+    config = cache.get(school_id)
+    if config is None:
+        config = _load(school_id)
+        if config is not None:
+            cache.set(school_id, config)
+    return config
+
+
+def invalidate_school_config(school_id):
+    if has_app_context() and school_id is not None:
+        school_config_cache().discard(int(school_id))
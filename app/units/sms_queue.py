@@ -0,0 +1,151 @@
+"""短信发送队列。
+
+SendSMS 只把任务放进 Redis 列表 sms:queue，由 flask sms_worker 取出
+调用短信服务商。发送失败（异常或返回的 Code 不是 OK）时按
+SMS_RETRY_BASE * 2^(n-1) 秒（最多 SMS_RETRY_MAX）延后重试，延后的任务
+放在有序集合 sms:delayed 中，到期后移回队列；失败 SMS_MAX_ATTEMPTS 次
+后连同最后的错误放进死信列表 sms:dead。
+
+任务取出后 worker 中断会丢失这一条，用户 60 秒后可以重新获取验证码。
+
+SMS_PROVIDER 为 fake 时使用本地的 FakeSmsProvider，不真正发送，
+按 SMS_FAKE_LATENCY 和 SMS_FAKE_FAIL_RATE 模拟耗时与失败。
+"""
+import json
+import time
+import random
+from flask import current_app
+from .. import redis_store
+
+QUEUE_KEY = 'sms:queue'
+DELAYED_KEY = 'sms:delayed'
+DEAD_KEY = 'sms:dead'
+STATS_KEY = 'sms:stats'
+
+# KEYS: 延后集合, 队列  ARGV: 当前时间, 最多移动的数量
+PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for i, job in ipairs(due) do
+    redis.call('ZREM', KEYS[1], job)
+    redis.call('RPUSH', KEYS[2], job)
+end
+return #due
+"""
+
+
+class FakeSmsProvider:
+    """本地假短信服务商，返回与阿里云短信接口相同格式的结果。"""
+
+    def __init__(self, latency=0, fail_rate=0):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.sent = []
+
+    def send_sms(self, business_id, phone_numbers, sign_name, template_code, template_param=None):
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.fail_rate:
+            return json.dumps({'Code': 'isv.BUSINESS_LIMIT_CONTROL', 'Message': 'fake failure'}).encode('utf-8')
+        self.sent.append((business_id, phone_numbers, template_code, template_param))
+        return json.dumps({'Code': 'OK', 'Message': 'OK', 'BizId': business_id}).encode('utf-8')
+
+
+def provider():
+    """返回 send_sms(business_id, phone_numbers, sign_name, template_code, template_param)。"""
+    app = current_app._get_current_object()
+    if app.config['SMS_PROVIDER'] == 'fake':
+        fake = app.extensions.get('sms_fake_provider')
+        if fake is None:
+            fake = app.extensions['sms_fake_provider'] = FakeSmsProvider(
+                app.config['SMS_FAKE_LATENCY'],
+                app.config['SMS_FAKE_FAIL_RATE']
+            )
+        return fake.send_sms
+    from ..dysms_python import demo_sms_send
+    return demo_sms_send.send_sms
+
+
+def make_job(smsuuid, phone_numbers, sign_name, template_code, params):
+    """返回放入 sms:queue 的任务内容。"""
+    return json.dumps({
+        'id': smsuuid,
+        'phone': phone_numbers,
+        'sign_name': sign_name,
+        'template': template_code,
+        'params': params,
+        'attempts': 0
+    })
+
+
+def enqueue(smsuuid, phone_numbers, sign_name, template_code, params):
+    redis_store.rpush(QUEUE_KEY, make_job(smsuuid, phone_numbers, sign_name, template_code, params))
+
+
+def _send(job):
+    """调用服务商，成功返回 None，失败返回错误说明。"""
+    try:
+        result = provider()(job['id'], job['phone'], job['sign_name'], job['template'], job['params'])
+        if isinstance(result, bytes):
+            result = result.decode('utf-8')
+        code = json.loads(result).get('Code')
+    except Exception as e:
+        return repr(e)
+    if code != 'OK':
+        return 'provider code %s' % code
+    return None
+
+
+def _retry_delay(attempts):
+    config = current_app.config
+    return min(config['SMS_RETRY_BASE'] * 2 ** (attempts - 1), config['SMS_RETRY_MAX'])
+
+
+def promote(now=None, limit=100):
+    """把到期的重试任务移回队列，返回移动的数量。"""
+    return redis_store.register_script(PROMOTE_SCRIPT)(
+        keys=[DELAYED_KEY, QUEUE_KEY],
+        args=[now or time.time(), limit]
+    )
+
+
+def work_once(timeout=0):
+    """处理一条任务，timeout 大于 0 时最多等待 timeout 秒。队列为空返回 False。"""
+    promote()
+    if timeout > 0:
+        item = redis_store.blpop(QUEUE_KEY, timeout)
+        raw = item[1] if item else None
+    else:
+        raw = redis_store.lpop(QUEUE_KEY)
+    if raw is None:
+        return False
+    job = json.loads(raw.decode('utf-8'))
+    error = _send(job)
+    if error is None:
+        redis_store.hincrby(STATS_KEY, 'sent', 1)
+        return True
+    job['attempts'] += 1
+    job['error'] = error
+    if job['attempts'] >= current_app.config['SMS_MAX_ATTEMPTS']:
+        current_app.logger.error('sms %s dead after %d attempts: %s', job['id'], job['attempts'], error)
+        redis_store.rpush(DEAD_KEY, json.dumps(job))
+    else:
+        current_app.logger.warning('sms %s attempt %d failed: %s', job['id'], job['attempts'], error)
+        due = time.time() + _retry_delay(job['attempts'])
+        # redis-py 各版本 zadd 参数不同，直接发命令
+        redis_store.execute_command('ZADD', DELAYED_KEY, due, json.dumps(job))
+        redis_store.hincrby(STATS_KEY, 'retried', 1)
+    return True
+
+
+def stats():
+    counters = dict(
+        (k.decode('utf-8'), int(v)) for k, v in redis_store.hgetall(STATS_KEY).items()
+    )
+    result = {
+        'queued': redis_store.llen(QUEUE_KEY),
+        'delayed': redis_store.zcard(DELAYED_KEY),
+        'dead': redis_store.llen(DEAD_KEY)
+    }
+    for name in ('sent', 'retried'):
+        result[name] = counters.get(name, 0)
+    return result
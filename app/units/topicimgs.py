@@ -0,0 +1,87 @@
+from flask import current_app
+from sqlalchemy import inspect
+from ..models import Topicimage, Ask, Answer, AskImage, AnswerImage, parse_img_ids
+from .. import db
+
+
+# 一次 IN 查询取出全部图片，返回 {id: img_url}
+def load_img_urls(ids):
+    ids = set(ids)
+    if not ids:
+        return {}
+    imgs = Topicimage.query.filter(Topicimage.id.in_(ids)).all()
+    return {img.id: img.img_url for img in imgs}
+
+
+# 校验提交的 img_ids，返回 (图片地址列表, 不存在的 id 列表)
+def resolve_img_ids(img_ids):
+    imgs = []
+    missing = []
+    if not img_ids:
+        return imgs, missing
+    urls = load_img_urls(parse_img_ids(img_ids))
+    for i in img_ids.split(','):
+        i = i.strip()
+        if i.isdigit() and int(i) in urls:
+            imgs.append(urls[int(i)])
+        else:
+            missing.append(i)
+    return imgs, missing
+
+
+# 按关联表一次取出一批问题/答案的图片，返回 {父 id: [img_url]}，已删除的图片 id 记入 missing
+def _load_linked(link, parent_col, parent_ids, missing):
+    linked = {}
+    if not parent_ids:
+        return linked
+    rows = db.session.query(parent_col, link.topicimage_id, Topicimage.img_url).outerjoin(
+        Topicimage, Topicimage.id == link.topicimage_id
+    ).filter(parent_col.in_(parent_ids)).order_by(parent_col, link.position)
+    for parent_id, img_id, img_url in rows:
+        urls = linked.setdefault(parent_id, [])
+        if img_url is None:
+            missing.add(img_id)
+        else:
+            urls.append(img_url)
+    return linked
+
+
+def attach_imgs(*groups):
+    """为一页问题/答案批量填充 .imgs，查询数与条数无关。
+
+    每个参数是一组 Ask 或 Answer，优先读取 ask_images/answer_images，
+    尚未回填的旧数据退回解析 img_ids。返回找不到的图片 id。
+    """
+    objs = [o for group in groups for o in group]
+    pending = []
+    legacy = []
+    missing = set()
+    for o in objs:
+        if not o.img_ids:
+            o.imgs = []
+        elif 'images' in inspect(o).unloaded:
+            pending.append(o)
+        elif o.images:
+            o.imgs = [link.image.img_url for link in o.images if link.image is not None]
+            missing.update(link.topicimage_id for link in o.images if link.image is None)
+        else:
+            legacy.append(o)
+    ask_ids = [o.id for o in pending if isinstance(o, Ask) and o.id]
+    answer_ids = [o.id for o in pending if isinstance(o, Answer) and o.id]
+    linked = {
+        Ask: _load_linked(AskImage, AskImage.ask_id, ask_ids, missing),
+        Answer: _load_linked(AnswerImage, AnswerImage.answer_id, answer_ids, missing)
+    }
+    for o in pending:
+        if o.id in linked[type(o)]:
+            o.imgs = linked[type(o)][o.id]
+        else:
+            legacy.append(o)
+    urls = load_img_urls(i for o in legacy for i in parse_img_ids(o.img_ids))
+    for o in legacy:
+        ids = parse_img_ids(o.img_ids)
+        o.imgs = [urls[i] for i in ids if i in urls]
+        missing.update(i for i in ids if i not in urls)
+    if missing:
+        current_app.logger.warning('topic images not found: %s', sorted(missing))
+    return missing
@@ -28,6 +28,16 @@ def rndColor2():
     return (random.randint(0, 48), random.randint(0, 48), random.randint(0, 48))
 
 
+# 噪点取值映射到 64~255，与 rndColor 相同的颜色范围
+NOISE_TABLE = [64 + b * 192 // 256 for b in range(256)] * 3
+
+
+# 整张随机噪点背景，一次生成全部像素
+def noiseImage(width, height):
+    image = Image.frombytes('RGB', (width, height), os.urandom(width * height * 3))
+    return image.point(NOISE_TABLE)
+
+
 # md5
 def md5Encode(str):
     m = hashlib.md5()
@@ -41,18 +51,13 @@ class VerCodeImg:
         self.width = 240
         self.height = 60
 
-    def create(self, savepath):
-
-        image = Image.new('RGB', (self.width, self.height), (255, 255, 255))
+    def render(self):
+        """返回 (图片, 验证码)。"""
+        image = noiseImage(self.width, self.height)
 
         # 创建Draw对象
         draw = ImageDraw.Draw(image)
 
-        # 填充每个像素
-        for x in range(self.width):
-            for y in range(self.height):
-                draw.point((x, y), fill=rndColor())
-
         # 组成文字
         rndCode = ''
         for t in range(4):
@@ -63,6 +68,10 @@ class VerCodeImg:
 
         # 模糊
         image = image.filter(ImageFilter.BLUR)
+        return image, rndCode
+
+    def create(self, savepath):
+        image, rndCode = self.render()
 
         # 文件名
         stringbase = string.ascii_letters + string.digits
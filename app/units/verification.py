@@ -0,0 +1,78 @@
+"""图片验证码与短信验证码的校验和发放。
+
+每个操作只有一次 Lua 调用：验证码不论对错都在读取的同时删除，
+同一个验证码不能被并发请求重复使用。
+
+    check_code(key, expected)         校验并作废验证码
+    check_sms_code(uuid, phone, code) 校验并作废短信验证码
+    send_sms_code(uuid, value, phone) 校验图片码、60 秒防刷、保存短信码并放入发送队列
+"""
+import uuid
+import random
+from .. import redis_store
+from . import sms_queue
+
+SMS_CODE_TTL = 3600
+PHONE_THROTTLE = 60
+SMS_SIGN_NAME = '麦学习软件'
+SMS_TEMPLATE = 'SMS_76030398'
+
+# send_sms_code 的结果
+CODE_INVALID = 0
+SENT = 1
+THROTTLED = 2
+
+# KEYS: 验证码  ARGV: 期望值
+CHECK_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if not value then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+if value == ARGV[1] then
+    return 1
+end
+return 0
+"""
+
+# KEYS: 图片验证码, 手机号防刷, 短信验证码, 短信队列
+# ARGV: 输入的图片码, 短信码值, 短信码过期时间, 防刷时间, 短信任务
+SEND_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if not value then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+if value ~= ARGV[1] then
+    return 0
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 2
+end
+redis.call('SETEX', KEYS[3], ARGV[3], ARGV[2])
+redis.call('SETEX', KEYS[2], ARGV[4], 'x')
+redis.call('RPUSH', KEYS[4], ARGV[5])
+return 1
+"""
+
+
+def check_code(key, expected):
+    """验证码正确返回 True；不论对错，验证码都被作废。"""
+    return redis_store.register_script(CHECK_SCRIPT)(keys=[key], args=[expected]) == 1
+
+
+def check_sms_code(smsuuid, telephone, phonecode):
+    return check_code(smsuuid, telephone + phonecode)
+
+
+def send_sms_code(captcha_uuid, captcha_value, phone_numbers):
+    """返回 (结果, 短信 uuid)，结果为 SENT、CODE_INVALID 或 THROTTLED。"""
+    smsuuid = phone_numbers + '-' + str(uuid.uuid1())
+    rndcode = ''.join(str(random.randint(0, 9)) for t in range(6))
+    job = sms_queue.make_job(smsuuid, phone_numbers, SMS_SIGN_NAME, SMS_TEMPLATE,
+                             {'code': rndcode, 'product': '麦学习答疑'})
+    status = redis_store.register_script(SEND_SCRIPT)(
+        keys=[captcha_uuid, phone_numbers, smsuuid, sms_queue.QUEUE_KEY],
+        args=[captcha_value, phone_numbers + rndcode, SMS_CODE_TTL, PHONE_THROTTLE, job]
+    )
+    return status, smsuuid
@@ -0,0 +1,81 @@
+"""访问微信接口的 HTTP 客户端。
+
+每个进程一个 requests.Session（放在 app.extensions['wx_client']），
+连接池大小 WX_HTTP_POOL_SIZE，保持长连接，登录时不必每次重新握手。
+连接失败与 5xx 按 WX_HTTP_RETRIES 次、WX_HTTP_RETRY_BACKOFF 退避重试；
+jscode2session 的 code 只能用一次，读超时不重试。
+
+WX_API_BASE 可指向本地的模拟服务，测试中不访问微信。
+每次调用记录耗时，stats() 返回本进程的调用次数、失败次数和耗时。
+"""
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import current_app
+
+
+class WxClient:
+
+    def __init__(self, base_url, pool_size=10, timeout=(2, 2), retries=2, backoff=0.1):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        retry = Retry(
+            total=retries,
+            read=0,
+            backoff_factor=backoff,
+            status_forcelist=(500, 502, 503, 504),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+
+    def _record(self, path, started, error):
+        cost = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self._stats['calls'] += 1
+            self._stats['errors'] += int(error)
+            self._stats['total_ms'] += cost
+            self._stats['max_ms'] = max(self._stats['max_ms'], cost)
+        current_app.logger.info('wx %s %.1f ms%s', path, cost, ' failed' if error else '')
+
+    def get_json(self, path, params):
+        started = time.perf_counter()
+        error = True
+        try:
+            response = self.session.get(self.base_url + path, params=params, timeout=self.timeout)
+            response.raise_for_status()
+            result = response.json()
+            error = False
+            return result
+        finally:
+            self._record(path, started, error)
+
+    def jscode2session(self, appid, secret, code):
+        params = {'appid': appid, 'secret': secret, 'js_code': code, 'grant_type': 'authorization_code'}
+        return self.get_json('/sns/jscode2session', params)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['avg_ms'] = stats['total_ms'] / stats['calls'] if stats['calls'] else 0.0
+        return stats
+
+
+def wx_client():
+    app = current_app._get_current_object()
+    client = app.extensions.get('wx_client')
+    if client is None:
+        client = app.extensions['wx_client'] = WxClient(
+            app.config['WX_API_BASE'],
+            app.config['WX_HTTP_POOL_SIZE'],
+            (app.config['WX_HTTP_CONNECT_TIMEOUT'], app.config['WX_HTTP_READ_TIMEOUT']),
+            app.config['WX_HTTP_RETRIES'],
+            app.config['WX_HTTP_RETRY_BACKOFF']
+        )
+    return client
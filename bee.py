@@ -1,8 +1,10 @@
 import os
+import time
 import click
 from flask_migrate import Migrate
 from app import create_app, db
-from app.models import Admin, School, Tcode, Course, Teacher, Student, Ask, Answer, Topicimage, Feedback, SchoolStudent
+from app.models import Admin, School, Tcode, Course, Teacher, Student, Ask, Answer, Topicimage, Feedback, SchoolStudent, \
+    AskImage, AnswerImage, SchoolCounter
 
 app = create_app(os.getenv('FLASK_ENV') or 'default')
 migrate = Migrate(app, db)
@@ -22,7 +24,10 @@ def make_shell_context():
         Ask=Ask,
         Answer=Answer,
         Topicimage=Topicimage,
-        Feedback=Feedback
+        AskImage=AskImage,
+        AnswerImage=AnswerImage,
+        Feedback=Feedback,
+        SchoolCounter=SchoolCounter
     )
 
 
@@ -47,3 +52,90 @@ def create_admin(name, password):
     db.session.add(admin)
     db.session.commit()
     click.echo('管理员 ' + name + ' 设置成功')
+
+
+@app.cli.command()
+def reconcile_counters():
+    """按实际数据修正问题/学生/教师计数。"""
+    fixed = SchoolCounter.reconcile()
+    click.echo('已修正 %d 条计数' % fixed)
+
+
+@app.cli.command()
+@click.option('--interval', default=0, help='大于0时每隔 interval 秒循环执行')
+def flush_quota(interval):
+    """把 Redis 账本中的提问次数写回数据库。"""
+    from app.units import quota
+    while True:
+        flushed = quota.flush(app.config['QUOTA_FLUSH_BATCH'])
+        click.echo('已写回 %d 条提问次数' % flushed)
+        if interval <= 0:
+            break
+        time.sleep(interval)
+
+
+@app.cli.command()
+@click.option('--interval', default=0, help='大于0时每隔 interval 秒循环补充')
+def fill_captchas(interval):
+    """补充图片验证码池；循环时每秒最多生成 CAPTCHA_POOL_REFILL_RATE 张。"""
+    from app.units import captcha_pool
+    while True:
+        started = time.time()
+        limit = app.config['CAPTCHA_POOL_REFILL_RATE'] * interval if interval > 0 else None
+        rendered = captcha_pool.fill(limit)
+        click.echo('已生成 %d 张验证码，池中 %d 张' % (rendered, captcha_pool.stats()['depth']))
+        if interval <= 0:
+            break
+        time.sleep(max(interval - (time.time() - started), 0))
+
+
+@app.cli.command()
+@click.option('--interval', default=0, help='大于0时每隔 interval 秒循环清理')
+@click.option('--scan', is_flag=True, help='先遍历一次目录，清理建索引之前的旧文件')
+def sweep_imgcodes(interval, scan):
+    """删除 imgcodes 目录中过期的验证码图片。"""
+    from app.units import imgcode_janitor
+    if scan:
+        click.echo('遍历目录删除 %d 张验证码图片' % imgcode_janitor.scan())
+    while True:
+        click.echo('已删除 %d 张验证码图片' % imgcode_janitor.sweep())
+        if interval <= 0:
+            break
+        time.sleep(interval)
+
+
+@app.cli.command()
+@click.option('--burst', is_flag=True, help='处理完队列中的任务后退出')
+def sms_worker(burst):
+    """从队列中取出短信任务发送，失败的任务延后重试。"""
+    from app.units import sms_queue
+    started = time.time()
+    processed = 0
+    while True:
+        if sms_queue.work_once(timeout=0 if burst else 5):
+            processed += 1
+        elif burst:
+            break
+    elapsed = time.time() - started
+    click.echo('处理 %d 条短信任务，%.1f 条/秒' % (processed, processed / elapsed if elapsed else 0))
+    click.echo(' '.join('%s=%d' % item for item in sorted(sms_queue.stats().items())))
+
+
+@app.cli.command()
+@click.option('--settings', default='pbkdf2:sha256:50000,pbkdf2:sha256:150000,bcrypt:10,bcrypt:12',
+              help='逗号分隔的 PASSWORD_HASH 取值')
+@click.option('--rounds', default=50, help='每种设置验证的次数')
+def bench_login(settings, rounds):
+    """测量各种密码哈希设置下登录验证的 p50/p99。"""
+    from app.units.passwords import hash_password, check_password
+    click.echo('%-24s %10s %10s' % ('PASSWORD_HASH', 'p50 ms', 'p99 ms'))
+    for setting in settings.split(','):
+        pwhash = hash_password('benchmark-password', setting)
+        costs = []
+        for i in range(rounds):
+            t = time.perf_counter()
+            check_password(pwhash, 'benchmark-password')
+            costs.append((time.perf_counter() - t) * 1000)
+        costs.sort()
+        p99 = costs[min(len(costs) - 1, int(len(costs) * 0.99))]
+        click.echo('%-24s %10.2f %10.2f' % (setting, costs[len(costs) // 2], p99))
@@ -0,0 +1,66 @@
+"""密码验证基准：对比每次 check_password_hash 与验证结果缓存的耗时。
+
+    python benchmarks/bench_password_verify.py --rounds 200
+
+测试配置的哈希轮数被调低过，这里固定用生产配置的 PASSWORD_HASH，可用 --method 覆盖。
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
+
+from flask import Flask  # noqa: E402
+from werkzeug.security import check_password_hash  # noqa: E402
+from config import config  # noqa: E402
+from app import db  # noqa: E402
+from app.models import Student  # noqa: E402
+
+
+def make_app(method):
+    app = Flask(__name__)
+    app.config.from_object(config['testing'])
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['PASSWORD_HASH'] = method
+    db.init_app(app)
+    return app
+
+
+def timeit(fn, rounds):
+    costs = []
+    for i in range(rounds):
+        t = time.perf_counter()
+        fn()
+        costs.append((time.perf_counter() - t) * 1000)
+    costs.sort()
+    return costs[len(costs) // 2], costs[int(len(costs) * 0.99) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--method', default=config['production'].PASSWORD_HASH)
+    opts = parser.parse_args()
+
+    app = make_app(opts.method)
+    with app.app_context():
+        db.create_all()
+        student = Student(telephone='15900000001', password='cat')
+        db.session.add(student)
+        db.session.commit()
+
+        cases = [
+            ('check_password_hash', lambda: check_password_hash(student.password_hash, 'cat')),
+            ('verify_password (cached)', lambda: student.verify_password('cat'))
+        ]
+        print('PASSWORD_HASH %s' % app.config['PASSWORD_HASH'])
+        print('%-28s %10s %10s %12s' % ('path', 'p50 ms', 'p99 ms', 'verify/s'))
+        for name, fn in cases:
+            p50, p99 = timeit(fn, opts.rounds)
+            print('%-28s %10.3f %10.3f %12.0f' % (name, p50, p99, 1000 / p50 if p50 else 0))
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,47 @@ class Config:
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024
     REDIS_URL = os.getenv('REDIS_URL')
     IMGCODE_FILE = os.path.join(basedir, os.path.pardir, 'imgcodes')
+    # 提问次数账本：redis 表示次数放在 Redis 中扣减并定期写回数据库
+    QUOTA_LEDGER = os.getenv('QUOTA_LEDGER') == 'redis'
+    QUOTA_FLUSH_BATCH = 500
+    # 学校成员缓存的过期时间（秒），0 表示不缓存
+    MEMBERSHIP_CACHE_TTL = 10 * 60
+    # token 验证结果缓存：条目数与过期时间（秒）
+    PRINCIPAL_CACHE_SIZE = 1024
+    PRINCIPAL_CACHE_TTL = 60
+    # 是否接受不带 role 的旧 token，旧 token 全部过期（最长 15 天）后关闭
+    TOKEN_ACCEPT_UNTAGGED = os.getenv('TOKEN_ACCEPT_UNTAGGED', '1') == '1'
+    # 密码验证结果缓存：条目数与过期时间（秒）
+    CREDENTIAL_CACHE_SIZE = 4096
+    CREDENTIAL_CACHE_TTL = 300
+    # 刷新 token 闲置多久后失效（秒），每次刷新重新计时
+    REFRESH_TOKEN_TTL = 30 * 24 * 3600
+    # 新密码的哈希算法与强度，见 app/units/passwords.py
+    PASSWORD_HASH = os.getenv('PASSWORD_HASH') or 'pbkdf2:sha256:50000'
+    # 图片验证码池：张数、每张保留时间（秒）、每秒最多补充的张数
+    CAPTCHA_POOL_SIZE = int(os.getenv('CAPTCHA_POOL_SIZE') or 500)
+    CAPTCHA_POOL_TTL = 3600
+    CAPTCHA_POOL_REFILL_RATE = int(os.getenv('CAPTCHA_POOL_REFILL_RATE') or 50)
+    # imgcodes 目录中验证码图片保留多久（秒），须长于答案的 580 秒
+    IMGCODE_MAX_AGE = 15 * 60
+    # 短信服务商：dysms 为阿里云短信，fake 为本地模拟
+    SMS_PROVIDER = os.getenv('SMS_PROVIDER') or 'dysms'
+    SMS_FAKE_LATENCY = float(os.getenv('SMS_FAKE_LATENCY') or 0)
+    SMS_FAKE_FAIL_RATE = float(os.getenv('SMS_FAKE_FAIL_RATE') or 0)
+    # 短信发送失败的重试：最多尝试次数、首次重试间隔与最长间隔（秒）
+    SMS_MAX_ATTEMPTS = 5
+    SMS_RETRY_BASE = 2
+    SMS_RETRY_MAX = 300
+    # 微信接口地址与 HTTP 连接池：每进程连接数、连接/读取超时（秒）、重试次数与退避系数
+    WX_API_BASE = os.getenv('WX_API_BASE') or 'https://api.weixin.qq.com'
+    WX_HTTP_POOL_SIZE = int(os.getenv('WX_HTTP_POOL_SIZE') or 10)
+    WX_HTTP_CONNECT_TIMEOUT = 2
+    WX_HTTP_READ_TIMEOUT = 2
+    WX_HTTP_RETRIES = 2
+    WX_HTTP_RETRY_BACKOFF = 0.1
+    # 学校配置缓存：条目数与过期时间（秒）
+    SCHOOL_CONFIG_CACHE_SIZE = 1024
+    SCHOOL_CONFIG_CACHE_TTL = 300
     
     @staticmethod
     def init_app(app):
@@ -28,6 +69,10 @@ class DevelopmentConfig(Config):
 
 class TestingConfig(Config):
     TESTING = True
+    MEMBERSHIP_CACHE_TTL = 0
+    PASSWORD_HASH = 'pbkdf2:sha256:1000'
+    CAPTCHA_POOL_SIZE = 3
+    SMS_PROVIDER = 'fake'
     SQLALCHEMY_DATABASE_URI = os.getenv('TEST_DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'data-test.sqlite')
 
 
@@ -0,0 +1,118 @@
+"""ask_images / answer_images association tables
+
+Revision ID: 3a5c7e21b9d4
+Revises: f1622591abc4
+Create Date: 2026-10-18 09:12:40.118204
+
+"""
+from contextlib import contextmanager
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a5c7e21b9d4'
+down_revision = 'f1622591abc4'
+branch_labels = None
+depends_on = None
+
+# 每批回填的父记录数，按主键游标推进，不做全表扫描锁
+BATCH_SIZE = 1000
+
+
+@contextmanager
+def batch_transaction(conn):
+    # MySQL/SQLite 的 DDL 不是事务性的，alembic 不开外层事务，这里每批单独提交，
+    # 中途失败时已完成的批次保留，重跑会跳过；外层已有事务（事务性 DDL）时随迁移一起提交
+    if conn.in_transaction():
+        yield
+    else:
+        with conn.begin():
+            yield
+
+
+def parse_img_ids(img_ids):
+    ids = []
+    for i in (img_ids or '').split(','):
+        i = i.strip()
+        if i.isdigit() and int(i) not in ids:
+            ids.append(int(i))
+    return ids
+
+
+def backfill(conn, parent_table, link_table, parent_key):
+    parent = sa.table(parent_table, sa.column('id'), sa.column('img_ids'))
+    images = sa.table('topicimages', sa.column('id'))
+    link = sa.table(
+        link_table,
+        sa.column(parent_key),
+        sa.column('topicimage_id'),
+        sa.column('position')
+    )
+    last_id = 0
+    while True:
+        with batch_transaction(conn):
+            rows = conn.execute(
+                sa.select([parent.c.id, parent.c.img_ids])
+                .where(parent.c.id > last_id)
+                .where(parent.c.img_ids.isnot(None))
+                .where(parent.c.img_ids != '')
+                .order_by(parent.c.id)
+                .limit(BATCH_SIZE)
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            wanted = set(i for r in rows for i in parse_img_ids(r[1]))
+            exists = set(
+                r[0] for r in conn.execute(
+                    sa.select([images.c.id]).where(images.c.id.in_(wanted))
+                )
+            ) if wanted else set()
+            done = set(
+                r[0] for r in conn.execute(
+                    sa.select([link.c[parent_key]]).distinct()
+                    .where(link.c[parent_key].in_([r[0] for r in rows]))
+                )
+            )
+            values = []
+            for parent_id, img_ids in rows:
+                if parent_id in done:
+                    continue
+                position = 0
+                for i in parse_img_ids(img_ids):
+                    if i in exists:
+                        values.append({parent_key: parent_id, 'topicimage_id': i, 'position': position})
+                        position += 1
+            if values:
+                op.bulk_insert(link, values)
+
+
+def upgrade():
+    op.create_table(
+        'ask_images',
+        sa.Column('ask_id', sa.Integer(), nullable=False),
+        sa.Column('topicimage_id', sa.Integer(), nullable=False),
+        sa.Column('position', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['ask_id'], ['asks.id'], ),
+        sa.ForeignKeyConstraint(['topicimage_id'], ['topicimages.id'], ),
+        sa.PrimaryKeyConstraint('ask_id', 'topicimage_id')
+    )
+    op.create_table(
+        'answer_images',
+        sa.Column('answer_id', sa.Integer(), nullable=False),
+        sa.Column('topicimage_id', sa.Integer(), nullable=False),
+        sa.Column('position', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['answer_id'], ['answers.id'], ),
+        sa.ForeignKeyConstraint(['topicimage_id'], ['topicimages.id'], ),
+        sa.PrimaryKeyConstraint('answer_id', 'topicimage_id')
+    )
+    # 旧数据回填：只读 asks/answers，按 id 分批写入关联表并逐批提交，已有关联的记录跳过，可重复执行
+    conn = op.get_bind()
+    backfill(conn, 'asks', 'ask_images', 'ask_id')
+    backfill(conn, 'answers', 'answer_images', 'answer_id')
+
+
+def downgrade():
+    op.drop_table('answer_images')
+    op.drop_table('ask_images')
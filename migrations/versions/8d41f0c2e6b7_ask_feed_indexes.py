@@ -0,0 +1,31 @@
+"""composite indexes for ask feeds
+
+Revision ID: 8d41f0c2e6b7
+Revises: 3a5c7e21b9d4
+Create Date: 2026-10-18 10:03:27.562931
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8d41f0c2e6b7'
+down_revision = '3a5c7e21b9d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_asks_school_id_id', 'asks', ['school_id', 'id'], unique=False)
+    op.create_index('ix_asks_school_id_be_answered_id', 'asks', ['school_id', 'be_answered', 'id'], unique=False)
+    op.create_index('ix_asks_school_id_student_id_id', 'asks', ['school_id', 'student_id', 'id'], unique=False)
+    op.create_index('ix_asks_school_id_student_id_be_answered_id', 'asks', ['school_id', 'student_id', 'be_answered', 'id'], unique=False)
+    op.create_index(op.f('ix_answers_ask_id'), 'answers', ['ask_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_answers_ask_id'), table_name='answers')
+    op.drop_index('ix_asks_school_id_student_id_be_answered_id', table_name='asks')
+    op.drop_index('ix_asks_school_id_student_id_id', table_name='asks')
+    op.drop_index('ix_asks_school_id_be_answered_id', table_name='asks')
+    op.drop_index('ix_asks_school_id_id', table_name='asks')
@@ -0,0 +1,34 @@
+"""school_counters table
+
+Revision ID: c5b2a9e47f13
+Revises: 8d41f0c2e6b7
+Create Date: 2026-10-18 11:20:05.734126
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5b2a9e47f13'
+down_revision = '8d41f0c2e6b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 计数行在首次读取时按实际数据初始化，这里不做回填
+    op.create_table(
+        'school_counters',
+        sa.Column('school_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('student_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('answered', sa.Integer(), nullable=True),
+        sa.Column('unanswered', sa.Integer(), nullable=True),
+        sa.Column('students', sa.Integer(), nullable=True),
+        sa.Column('teachers', sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint('school_id', 'student_id')
+    )
+
+
+def downgrade():
+    op.drop_table('school_counters')
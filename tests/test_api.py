@@ -1,5 +1,34 @@
+import json
 import unittest
-from app import create_app, db
+import base64
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sqlalchemy import event
+from app import create_app, db, redis_store
+from app.models import School, Teacher, Student, Course, Ask, Answer, SchoolStudent
+from app.units.principals import principal_cache
+from app.units import refresh_tokens, captcha_pool, sms_queue
+from app.units.wxclient import wx_client
+
+
+class WxStubHandler(BaseHTTPRequestHandler):
+    """模拟微信 jscode2session，code 为 busy 时第一次返回 503。"""
+    protocol_version = 'HTTP/1.1'
+    calls = []
+
+    def do_GET(self):
+        self.calls.append(self.path)
+        if 'js_code=busy' in self.path and len(self.calls) == 1:
+            status, body = 503, b'busy'
+        else:
+            status, body = 200, json.dumps({'openid': 'openid-1', 'session_key': 'key'}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
 
 
 class APITestCase(unittest.TestCase):
@@ -10,7 +39,241 @@ class APITestCase(unittest.TestCase):
         db.create_all()
     
     def tearDown(self):
+        db.session.remove()
         db.drop_all()
         self.app_context.pop()
 
-    
\ No newline at end of file
+    def get_api_headers(self, username, password):
+        return {
+            'Authorization': 'Basic ' + base64.b64encode(
+                (username + ':' + password).encode('utf-8')).decode('utf-8'),
+            'Accept': 'application/json',
+            'Content-Type': 'application/json'
+        }
+
+    def count_queries(self, fn):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = fn()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return response, len(statements)
+
+    def make_school(self):
+        sc = School(name='aschool', admin='13700000001')
+        t = Teacher(telephone='13700000001', password='cat', nickname='teacher')
+        st = Student(telephone='15900000001', password='cat', nickname='student')
+        t.schools.append(sc)
+        db.session.add_all([sc, t, st])
+        db.session.commit()
+        db.session.add(Course(course_name='acourse', school_id=sc.id))
+        db.session.commit()
+        st.join_school(sc.id)
+        return sc, t, st
+
+    def test_school_ask_list_query_count(self):
+        sc, t, st = self.make_school()
+        for i in range(12):
+            ask = Ask(school_id=sc.id, student_id=st.id, ask_text='ask')
+            for j in range(3):
+                ask.answers.append(Answer(teacher_id=t.id, answer_text='answer'))
+            db.session.add(ask)
+        db.session.commit()
+        headers = self.get_api_headers('13700000001', 'cat')
+        client = self.app.test_client()
+        url = '/v1/school/student/asks?school_id=%d&student_id=%d&per_page=%d&answer_limit=2'
+
+        def fetch(per_page):
+            db.session.expire_all()
+            return client.get(url % (sc.id, st.id, per_page), headers=headers)
+
+        fetch(1)
+        response, small = self.count_queries(lambda: fetch(2))
+        self.assertEqual(response.status_code, 200)
+        response, large = self.count_queries(lambda: fetch(10))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(small, large)
+        asks = response.get_json()['asks']
+        self.assertEqual(len(asks), 10)
+        self.assertTrue(all(len(ask['answers']) == 2 for ask in asks))
+
+    def test_ask_quota_under_concurrency(self):
+        sc, t, st = self.make_school()
+        member_info = SchoolStudent.query.filter_by(school_id=sc.id, student_id=st.id).first()
+        member_info.vip_times = 0
+        member_info.nomal_times = 3
+        db.session.commit()
+        school_id = sc.id
+        student_id = st.id
+        headers = self.get_api_headers('15900000001', 'cat')
+        statuses = []
+
+        def post_ask():
+            client = self.app.test_client()
+            response = client.post(
+                '/v1/student/asks',
+                headers=headers,
+                json={'school_id': school_id, 'ask_text': 'ask'}
+            )
+            statuses.append(response.status_code)
+
+        threads = [threading.Thread(target=post_ask) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(statuses.count(200), 3)
+        self.assertEqual(statuses.count(403), 5)
+        db.session.expire_all()
+        member_info = SchoolStudent.query.filter_by(school_id=school_id, student_id=student_id).first()
+        self.assertEqual(member_info.nomal_times, 0)
+        self.assertEqual(Ask.query.filter_by(student_id=student_id).count(), 3)
+
+    def test_token_principal_cache(self):
+        sc, t, st = self.make_school()
+        token = st.generate_auth_token(600)
+        student_id = st.id
+        headers = self.get_api_headers(token, '')
+        client = self.app.test_client()
+
+        def fetch():
+            db.session.expunge_all()
+            return client.get('/v1/student/token', headers=headers)
+
+        response, first = self.count_queries(fetch)
+        self.assertEqual(response.status_code, 200)
+        response, second = self.count_queries(fetch)
+        self.assertEqual(response.status_code, 200)
+        # 命中时省掉加载学生的查询，剩下的是生成新 token 时读取权限
+        self.assertEqual(second, first - 1)
+        self.assertEqual(principal_cache().stats()['hits'], 1)
+
+        # 停用学生后缓存失效
+        student = Student.query.get(student_id)
+        student.disabled = True
+        db.session.commit()
+        self.assertEqual(principal_cache().stats()['size'], 0)
+
+    def test_refresh_token_rotation(self):
+        sc, t, st = self.make_school()
+        client = self.app.test_client()
+        response = client.get('/v1/student/token', headers=self.get_api_headers('15900000001', 'cat'))
+        first = response.get_json()['refresh_token']
+
+        def refresh(refresh_token):
+            return client.post('/v1/public/token/refresh', json={'refresh_token': refresh_token})
+
+        response = refresh(first)
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(data['role'], 'student')
+        self.assertNotEqual(data['refresh_token'], first)
+        response = client.get('/v1/student/token', headers=self.get_api_headers(data['token'], ''))
+        self.assertEqual(response.status_code, 200)
+        # 用访问 token 换 token 时不发新的刷新 token
+        self.assertNotIn('refresh_token', response.get_json())
+
+        # 旧 token 被重放，整个会话作废
+        self.assertEqual(refresh(first).status_code, 401)
+        self.assertEqual(refresh(data['refresh_token']).status_code, 401)
+
+    def test_revoke_all_sessions(self):
+        sc, t, st = self.make_school()
+        client = self.app.test_client()
+        headers = self.get_api_headers('13700000001', 'cat')
+        refresh_tokens.revoke_all('teacher', t.id)
+        tokens = [client.get('/v1/school/token', headers=headers).get_json()['refresh_token'] for i in range(2)]
+        response = client.delete('/v1/school/sessions', headers=headers)
+        self.assertEqual(response.get_json()['revoked'], 2)
+        for refresh_token in tokens:
+            response = client.post('/v1/public/token/refresh', json={'refresh_token': refresh_token})
+            self.assertEqual(response.status_code, 401)
+
+    def test_captcha_pool(self):
+        redis_store.delete(captcha_pool.POOL_KEY, captcha_pool.STATS_KEY)
+        self.assertEqual(captcha_pool.fill(), 3)
+        self.assertEqual(captcha_pool.fill(), 0)
+        # 池头条目过期后补池时去掉
+        redis_store.delete(captcha_pool.ENTRY_KEY % redis_store.lindex(captcha_pool.POOL_KEY, 0).decode('utf-8'))
+        self.assertEqual(captcha_pool.fill(), 1)
+        self.assertEqual(captcha_pool.stats()['expired'], 1)
+        client = self.app.test_client()
+        response = client.get('/v1/public/captcha')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, 'image/jpeg')
+        self.assertTrue(response.data.startswith(b'\xff\xd8'))
+        self.assertIsNotNone(redis_store.get(response.headers['X-Captcha-Uuid']))
+        response = client.get('/v1/public/captcha?format=datauri')
+        self.assertTrue(response.get_json()['imgdata'].startswith('data:image/jpeg;base64,'))
+
+        # 池取空后当场生成
+        client.get('/v1/public/captcha')
+        response = client.get('/v1/public/captcha')
+        self.assertEqual(response.status_code, 200)
+        stats = captcha_pool.stats()
+        self.assertEqual((stats['depth'], stats['served'], stats['underflow']), (0, 3, 1))
+        redis_store.delete(captcha_pool.POOL_KEY, captcha_pool.STATS_KEY)
+
+    def test_sms_code_register(self):
+        client = self.app.test_client()
+        phone = '13600000009'
+        redis_store.delete(sms_queue.QUEUE_KEY, phone)
+
+        def send(captcha):
+            return client.post('/v1/public/sendsms', json={'uuid': 'cap-1', 'inputvalue': captcha, 'phone_numbers': phone})
+
+        redis_store.setex('cap-1', 580, '1234')
+        self.assertEqual(send('1234').status_code, 200)
+        # 图片码已被使用
+        self.assertEqual(send('1234').status_code, 403)
+        redis_store.setex('cap-1', 580, '1234')
+        response = send('1234')
+        self.assertEqual(response.get_json()['message'], '请求太频繁')
+
+        job = json.loads(redis_store.lpop(sms_queue.QUEUE_KEY).decode('utf-8'))
+        self.assertEqual(job['phone'], phone)
+        reg = {'telephone': phone, 'password': 'password', 'uuid': job['id'], 'phonecode': job['params']['code']}
+        response = client.post('/v1/public/teacher/register', json=dict(reg, phonecode='x'))
+        self.assertEqual(response.status_code, 403)
+        # 输错一次后短信码作废
+        response = client.post('/v1/public/teacher/register', json=reg)
+        self.assertEqual(response.status_code, 403)
+
+        redis_store.delete(phone)
+        redis_store.setex('cap-1', 580, '1234')
+        self.assertEqual(send('1234').status_code, 200)
+        job = json.loads(redis_store.lpop(sms_queue.QUEUE_KEY).decode('utf-8'))
+        reg.update(uuid=job['id'], phonecode=job['params']['code'])
+        response = client.post('/v1/public/teacher/register', json=reg)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.get_json()['teacher']['telephone'], phone)
+        redis_store.delete(sms_queue.QUEUE_KEY, phone)
+
+    def test_wx_login_via_pooled_client(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), WxStubHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        WxStubHandler.calls = []
+        self.app.config['WX_API_BASE'] = 'http://127.0.0.1:%d' % server.server_port
+        client = self.app.test_client()
+        try:
+            response = client.post('/v1/public/wxteacherlogin', json={'code': 'busy'})
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(response.get_json()['teacher']['register'])
+            response = client.post('/v1/public/wxteacherlogin', json={'code': 'again'})
+            self.assertEqual(response.status_code, 200)
+        finally:
+            wx_client().session.close()
+            server.shutdown()
+            server.server_close()
+        # 503 重试一次
+        self.assertEqual(len(WxStubHandler.calls), 3)
+        self.assertTrue(WxStubHandler.calls[0].startswith('/sns/jscode2session?'))
+        stats = wx_client().stats()
+        self.assertEqual((stats['calls'], stats['errors']), (2, 0))
+        self.assertEqual(Teacher.query.filter_by(wx_openid='openid-1').count(), 1)
@@ -1,8 +1,11 @@
 import unittest
 import time
 from datetime import datetime, timedelta
+from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from app import create_app, db
-from app.models import Admin, School, Teacher, Tcode, Student, Course, SchoolStudent
+from app.models import Admin, School, Teacher, Tcode, Student, Course, SchoolStudent, Ask, Answer, \
+    SchoolCounter
+from app.units.credentials import credential_cache
 
 
 class ModelTestCase(unittest.TestCase):
@@ -75,6 +78,39 @@ class ModelTestCase(unittest.TestCase):
         self.assertTrue(u.verify_password('cat'))
         self.assertFalse(u.verify_password('dog'))
 
+    def test_teacher_password_verification_cache(self):
+        u = Teacher(password='cat')
+        db.session.add(u)
+        db.session.commit()
+        cache = credential_cache()
+        self.assertTrue(u.verify_password('cat'))
+        self.assertTrue(u.verify_password('cat'))
+        self.assertFalse(u.verify_password('dog'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['size'], 1)
+        self.assertFalse(any('cat' in key for key in cache._data))
+        u.password = 'dog'
+        self.assertEqual(cache.stats()['size'], 0)
+        self.assertFalse(u.verify_password('cat'))
+        self.assertTrue(u.verify_password('dog'))
+
+    def test_teacher_password_rehash_on_login(self):
+        u = Teacher(password='cat')
+        db.session.add(u)
+        db.session.commit()
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.app.config['PASSWORD_HASH'] = 'pbkdf2:sha256:2000'
+        self.assertFalse(u.verify_password('dog'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        # 重算只更新哈希列，不提交会话中其他未提交的修改
+        u.nickname = 'pending'
+        self.assertTrue(u.verify_password('cat'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+        db.session.rollback()
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertIsNone(u.nickname)
+        self.assertTrue(u.verify_password('cat'))
+
     def test_teacher_password_salts_are_random(self):
         u = Teacher(password='cat')
         u2 = Teacher(password='cat')
@@ -104,6 +140,27 @@ class ModelTestCase(unittest.TestCase):
         time.sleep(2)
         self.assertFalse(u.verify_auth_token(token) == u)
 
+    def test_token_role(self):
+        t = Teacher(password='cat')
+        st = Student(password='cat')
+        db.session.add_all([t, st])
+        db.session.commit()
+        self.assertEqual(t.id, st.id)
+        token = t.generate_auth_token()
+        self.assertFalse(Student.verify_auth_token(token))
+        self.assertTrue(Teacher.verify_auth_token(token) == t)
+
+    def test_untagged_token(self):
+        t = Teacher(password='cat')
+        db.session.add(t)
+        db.session.commit()
+        s = Serializer(self.app.config['SECRET_KEY'], expires_in=600)
+        token = s.dumps({'id': t.id}).decode('utf-8')
+        self.assertTrue(Teacher.verify_auth_token(token) == t)
+        self.app.config['TOKEN_ACCEPT_UNTAGGED'] = False
+        self.app.extensions['principal_cache'].clear()
+        self.assertFalse(Teacher.verify_auth_token(token))
+
     # school test
     def test_generate_tcode(self):
         s = School(name='aschool')
@@ -203,6 +260,25 @@ class ModelTestCase(unittest.TestCase):
         st.join_school(sc.id)
         self.assertTrue(st.is_school_joined(sc.id))
 
+    def test_student_provision_wx(self):
+        sc = School(name='aschool')
+        db.session.add(sc)
+        db.session.commit()
+        db.session.add(Course(course_name='acourse', school_id=sc.id, nomal_times=3, vip_times=0))
+        db.session.commit()
+        st = Student.provision_wx(sc.id, 'openid-1', 'key-1')
+        member_info = SchoolStudent.query.filter_by(wx_openid='openid-1').first()
+        self.assertEqual(member_info.student_id, st.id)
+        self.assertEqual((member_info.nomal_times, member_info.wx_sessionkey), (3, 'key-1'))
+        self.assertTrue(st.is_school_joined(sc.id))
+        # 同一 openid 并发登录：唯一约束冲突后更新已有会员，不多建学生
+        again = Student.provision_wx(sc.id, 'openid-1', 'key-2')
+        self.assertEqual(again.id, st.id)
+        self.assertEqual(Student.query.count(), 1)
+        db.session.refresh(member_info)
+        self.assertEqual(member_info.wx_sessionkey, 'key-2')
+        self.assertEqual(SchoolCounter.fetch(sc.id).students, 1)
+
     def test_student_can_ask(self):
         sc01 = School(name='school01')
         st01 = Student(nickname='student01')
@@ -302,4 +378,91 @@ class ModelTestCase(unittest.TestCase):
         self.assertTrue(st05.can_ask(sc05.id))
 
         self.assertFalse(st05.can_ask(sc04.id))
-        
\ No newline at end of file
+        
+
+    # counters
+    def test_school_counter(self):
+        sc = School(name='aschool')
+        st = Student(nickname='astudent')
+        t = Teacher(telephone='13700000000')
+        t.schools.append(sc)
+        db.session.add_all([sc, st, t])
+        db.session.commit()
+        db.session.add(Course(course_name='acourse', school_id=sc.id))
+        db.session.add(Ask(school_id=sc.id, student_id=st.id))
+        db.session.commit()
+        st.join_school(sc.id)
+        counter = SchoolCounter.fetch(sc.id, st.id)
+        self.assertEqual(counter.asks(), 1)
+        self.assertEqual(SchoolCounter.fetch(sc.id).students, 1)
+        self.assertEqual(SchoolCounter.fetch(sc.id).teachers, 1)
+
+        ask = Ask(school_id=sc.id, student_id=st.id)
+        db.session.add(ask)
+        db.session.commit()
+        ask.answers.append(Answer(teacher_id=t.id))
+        db.session.commit()
+        counter = SchoolCounter.fetch(sc.id, st.id)
+        self.assertEqual(counter.asks(True), 1)
+        self.assertEqual(counter.asks(False), 1)
+        self.assertEqual(SchoolCounter.fetch(sc.id).asks(), 2)
+
+        db.session.delete(ask)
+        t.dismiss_school(sc.id)
+        self.assertEqual(SchoolCounter.fetch(sc.id, st.id).asks(), 1)
+        self.assertEqual(SchoolCounter.fetch(sc.id).asks(True), 0)
+        self.assertEqual(SchoolCounter.fetch(sc.id).teachers, 0)
+
+    def test_school_counter_reconcile(self):
+        sc = School(name='aschool')
+        db.session.add(sc)
+        db.session.commit()
+        counter = SchoolCounter.fetch(sc.id)
+        counter.unanswered = 10
+        db.session.commit()
+        self.assertEqual(SchoolCounter.reconcile(), 1)
+        self.assertEqual(SchoolCounter.fetch(sc.id).asks(), 0)
+
+    def test_ask_preload_answers_limit(self):
+        asks = [Ask(school_id=1, student_id=1) for i in range(2)]
+        for ask in asks:
+            ask.answers = [Answer(answer_text=str(j)) for j in range(5)]
+        db.session.add_all(asks)
+        db.session.commit()
+        db.session.expunge_all()
+        asks = Ask.query.order_by(Ask.id).all()
+        Ask.preload_answers(asks, 2)
+        self.assertEqual([[a.answer_text for a in ask.page_answers] for ask in asks], [['0', '1'], ['0', '1']])
+        # 超出 limit 的答案没有从数据库取回
+        loaded = [o for o in db.session.identity_map.values() if isinstance(o, Answer)]
+        self.assertEqual(len(loaded), 4)
+        Ask.preload_answers(asks)
+        self.assertEqual(len(asks[0].page_answers), 5)
+
+    def test_consume_ask(self):
+        sc = School(name='aschool')
+        st = Student(nickname='astudent')
+        db.session.add_all([sc, st])
+        db.session.commit()
+        db.session.add(Course(course_name='acourse', school_id=sc.id, nomal_times=1, vip_times=1))
+        db.session.commit()
+        st.join_school(sc.id)
+        member_info = SchoolStudent.query.filter_by(school_id=sc.id, student_id=st.id).first()
+        member_info.vip_expire = datetime.utcnow() + timedelta(days=1)
+        db.session.commit()
+        # 先扣会员次数，再扣普通次数，用完后失败
+        self.assertTrue(SchoolStudent.consume_ask(sc.id, st.id))
+        self.assertTrue(SchoolStudent.consume_ask(sc.id, st.id))
+        self.assertFalse(SchoolStudent.consume_ask(sc.id, st.id))
+        db.session.commit()
+        db.session.refresh(member_info)
+        self.assertEqual((member_info.vip_times, member_info.nomal_times), (0, 0))
+        self.assertFalse(st.can_ask(sc.id))
+        # 会员不限次数时不扣普通次数
+        member_info.vip_times = -1
+        member_info.nomal_times = 2
+        db.session.commit()
+        self.assertTrue(SchoolStudent.consume_ask(sc.id, st.id))
+        db.session.commit()
+        db.session.refresh(member_info)
+        self.assertEqual((member_info.vip_times, member_info.nomal_times), (-1, 2))
@@ -0,0 +1,437 @@
+import os
+import time
+import tempfile
+import unittest
+import importlib.util
+from datetime import datetime, timedelta
+from werkzeug.exceptions import BadRequest
+from app import create_app, db, redis_store
+from app.models import Ask, Answer, Topicimage, Teacher, Student, School, Course, SchoolStudent, employs, \
+    parse_img_ids
+from app.units.topicimgs import attach_imgs, resolve_img_ids
+from app.units.paging import KeysetPage, encode_cursor, decode_cursor
+from app.units.authors import attach_authors
+from app.units import quota, membership, capabilities, vercode, imgcode_janitor, sms_queue
+from app.units.loader import get_entity, entity_stats, reset_entities
+from app.units.principals import PrincipalCache, Principal
+from app.units.passwords import hash_password, check_password, needs_rehash
+from app.units.school_config import get_school_config, school_config_cache
+
+
+class AppTestCase(unittest.TestCase):
+    """testing 应用加上下文和空库；config 覆盖配置，redis_keys 在前后清理。"""
+    config = {}
+    redis_keys = []
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config.update(self.config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.clear_redis()
+
+    def tearDown(self):
+        self.clear_redis()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def clear_redis(self):
+        if self.redis_keys:
+            redis_store.delete(*self.redis_keys)
+
+
+class UnitsTestCase(AppTestCase):
+
+    # topic images
+    def test_parse_img_ids(self):
+        self.assertEqual(parse_img_ids(None), [])
+        self.assertEqual(parse_img_ids('3,1, 2,,x'), [3, 1, 2])
+
+    def test_attach_imgs(self):
+        i1 = Topicimage(img_url='uploads/1.jpg')
+        i2 = Topicimage(img_url='uploads/2.jpg')
+        db.session.add_all([i1, i2])
+        db.session.commit()
+        ask = Ask(img_ids='%s,%s' % (i2.id, i1.id))
+        answer = Answer(img_ids='%s,999' % i1.id)
+        empty = Answer()
+        missing = attach_imgs([ask], [answer, empty])
+        self.assertEqual(ask.imgs, ['uploads/2.jpg', 'uploads/1.jpg'])
+        self.assertEqual(answer.imgs, ['uploads/1.jpg'])
+        self.assertEqual(empty.imgs, [])
+        self.assertEqual(missing, {999})
+
+    def test_resolve_img_ids(self):
+        i1 = Topicimage(img_url='uploads/1.jpg')
+        db.session.add(i1)
+        db.session.commit()
+        imgs, missing = resolve_img_ids(str(i1.id))
+        self.assertEqual(imgs, ['uploads/1.jpg'])
+        self.assertEqual(missing, [])
+        imgs, missing = resolve_img_ids('%s,abc,999' % i1.id)
+        self.assertEqual(missing, ['abc', '999'])
+
+    def test_attach_imgs_from_links(self):
+        i1 = Topicimage(img_url='uploads/1.jpg')
+        i2 = Topicimage(img_url='uploads/2.jpg')
+        db.session.add_all([i1, i2])
+        db.session.commit()
+        ask = Ask()
+        ask.set_images('%s,%s' % (i2.id, i1.id))
+        legacy = Ask(img_ids=str(i1.id))
+        db.session.add_all([ask, legacy])
+        db.session.commit()
+        db.session.expire_all()
+        asks = Ask.query.order_by(Ask.id).all()
+        self.assertEqual([link.position for link in asks[0].images], [0, 1])
+        attach_imgs(asks)
+        self.assertEqual(asks[0].imgs, ['uploads/2.jpg', 'uploads/1.jpg'])
+        self.assertEqual(asks[1].imgs, ['uploads/1.jpg'])
+
+    def test_attach_imgs_deleted_link(self):
+        i1 = Topicimage(img_url='uploads/1.jpg')
+        i2 = Topicimage(img_url='uploads/2.jpg')
+        db.session.add_all([i1, i2])
+        db.session.commit()
+        ask = Ask()
+        ask.set_images('%s,%s' % (i2.id, i1.id))
+        db.session.add(ask)
+        db.session.commit()
+        deleted = i2.id
+        Topicimage.query.filter_by(id=deleted).delete()
+        db.session.commit()
+        db.session.expire_all()
+        asks = Ask.query.all()
+        self.assertEqual(attach_imgs(asks), {deleted})
+        self.assertEqual(asks[0].imgs, ['uploads/1.jpg'])
+
+    # keyset paging
+    def test_cursor_roundtrip(self):
+        self.assertEqual(decode_cursor(encode_cursor(42)), 42)
+        self.assertTrue(decode_cursor('') is None)
+
+    def test_keyset_page(self):
+        db.session.add_all([Ask(school_id=1) for i in range(5)])
+        db.session.commit()
+        query = Ask.query.filter_by(school_id=1)
+        first = KeysetPage(query, Ask.id, '', 2)
+        self.assertEqual([a.id for a in first.items], [5, 4])
+        self.assertTrue(first.has_next)
+        second = KeysetPage(query, Ask.id, first.next_cursor, 2)
+        self.assertEqual([a.id for a in second.items], [3, 2])
+        last = KeysetPage(query, Ask.id, second.next_cursor, 2)
+        self.assertEqual([a.id for a in last.items], [1])
+        self.assertFalse(last.has_next)
+        self.assertTrue(last.next_cursor is None)
+        for per_page in (0, -1):
+            with self.assertRaises(BadRequest):
+                KeysetPage(query, Ask.id, '', per_page)
+
+    # answer authors
+    def test_attach_authors(self):
+        t = Teacher(nickname='teacher', imgurl='t.jpg')
+        st = Student(nickname='student')
+        db.session.add_all([t, st])
+        db.session.commit()
+        a1 = Answer(teacher_id=t.id)
+        a2 = Answer(student_id=st.id)
+        attach_authors([a1, a2])
+        self.assertEqual(a1.teacher_nickname, 'teacher')
+        self.assertEqual(a1.teacher_imgurl, 't.jpg')
+        self.assertEqual(a2.student_nickname, 'student')
+        self.assertFalse(hasattr(a2, 'teacher_nickname'))
+
+    # request-scoped loader
+    def test_get_entity(self):
+        t = Teacher(nickname='teacher')
+        db.session.add(t)
+        db.session.commit()
+        with self.app.test_request_context('/'):
+            self.assertIs(get_entity(Teacher, t.id), get_entity(Teacher, str(t.id)))
+            self.assertIsNone(get_entity(Teacher, 999))
+            self.assertIsNone(get_entity(Teacher, 999))
+            self.assertEqual(entity_stats(), {'hit': 2, 'miss': 2})
+            reset_entities()
+            self.assertEqual(entity_stats(), {'hit': 0, 'miss': 0})
+
+    # password hashing policy
+    def test_password_policy(self):
+        pwhash = hash_password('cat', 'pbkdf2:sha256:1000')
+        self.assertTrue(check_password(pwhash, 'cat'))
+        self.assertFalse(needs_rehash(pwhash, 'pbkdf2:sha256:1000'))
+        self.assertTrue(needs_rehash(pwhash, 'pbkdf2:sha256:2000'))
+        self.assertFalse(needs_rehash(pwhash, 'pbkdf2:sha256'))
+        self.assertTrue(needs_rehash(pwhash, 'bcrypt:4'))
+
+    @unittest.skipUnless(importlib.util.find_spec('bcrypt'), '需要 bcrypt')
+    def test_password_policy_bcrypt(self):
+        pwhash = hash_password('cat', 'bcrypt:4')
+        self.assertTrue(check_password(pwhash, 'cat'))
+        self.assertFalse(check_password(pwhash, 'dog'))
+        self.assertFalse(needs_rehash(pwhash, 'bcrypt:4'))
+        self.assertTrue(needs_rehash(pwhash, 'bcrypt:5'))
+        self.assertTrue(needs_rehash(pwhash, 'pbkdf2:sha256:1000'))
+
+    # principal cache
+    def test_principal_cache(self):
+        cache = PrincipalCache(maxsize=2, ttl=60)
+        cache.set('a', Principal(1, 'student', None, False, None))
+        cache.set('b', Principal(2, 'student', None, False, None))
+        self.assertEqual(cache.get('a').id, 1)
+        cache.set('c', Principal(1, 'teacher', None, False, None))
+        # b 最久未用，被淘汰
+        self.assertIsNone(cache.get('b'))
+        cache.set('d', Principal(1, 'student', None, False, None), expires_at=0)
+        self.assertIsNone(cache.get('d'))
+        cache.invalidate('student', 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c').role, 'teacher')
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 3))
+
+    # school config cache
+    def test_school_config_cache(self):
+        s = School(name='aschool', wx_appid='appid-1', wx_appsecret='secret')
+        db.session.add(s)
+        db.session.commit()
+        self.assertEqual(get_school_config(s.id).nomal_times, None)
+        course = Course(course_name='c', school_id=s.id, nomal_times=7, vip_times=0)
+        db.session.add(course)
+        db.session.commit()
+        config = get_school_config(s.id)
+        self.assertEqual((config.wx_appid, config.nomal_times, config.vip_times), ('appid-1', 7, 0))
+        self.assertIs(get_school_config(str(s.id)), config)
+        s.wx_appid = 'appid-2'
+        db.session.commit()
+        self.assertEqual(get_school_config(s.id).wx_appid, 'appid-2')
+        course.nomal_times = 9
+        db.session.commit()
+        self.assertEqual(get_school_config(s.id).nomal_times, 9)
+        self.assertIsNone(get_school_config(s.id + 1))
+        self.assertEqual(school_config_cache().stats()['hits'], 1)
+
+    # captcha image
+    def test_captcha_render(self):
+        noise = vercode.noiseImage(240, 60)
+        self.assertEqual(noise.getextrema(), ((64, 255), (64, 255), (64, 255)))
+        image, code = vercode.VerCodeImg().render()
+        self.assertEqual(image.size, (240, 60))
+        self.assertRegex(code, r'^\d{4}$')
+
+
+class ImgcodeJanitorTestCase(AppTestCase):
+    redis_keys = [imgcode_janitor.INDEX_KEY]
+
+    def setUp(self):
+        super().setUp()
+        self.folder = tempfile.TemporaryDirectory()
+        self.app.config['IMGCODE_FILE'] = self.folder.name
+
+    def tearDown(self):
+        super().tearDown()
+        self.folder.cleanup()
+
+    def test_sweep_and_scan(self):
+        names = [vercode.VerCodeImg().create(self.folder.name)['fileName'] for i in range(3)]
+        for name in names:
+            imgcode_janitor.track(name)
+        # 索引之外的旧文件
+        stale = os.path.join(self.folder.name, 'stale.jpg')
+        open(stale, 'w').close()
+        os.utime(stale, (0, 0))
+
+        self.assertEqual(imgcode_janitor.sweep(), 0)
+        later = time.time() + self.app.config['IMGCODE_MAX_AGE'] + 1
+        self.assertEqual(imgcode_janitor.sweep(batch=2, now=later), 3)
+        self.assertEqual(os.listdir(self.folder.name), ['stale.jpg'])
+        self.assertEqual(redis_store.zcard(imgcode_janitor.INDEX_KEY), 0)
+        self.assertEqual(imgcode_janitor.scan(), 1)
+        self.assertEqual(os.listdir(self.folder.name), [])
+
+
+class SmsQueueTestCase(AppTestCase):
+    config = {'SMS_MAX_ATTEMPTS': 2}
+    redis_keys = [sms_queue.QUEUE_KEY, sms_queue.DELAYED_KEY, sms_queue.DEAD_KEY, sms_queue.STATS_KEY]
+
+    def setUp(self):
+        super().setUp()
+        self.fake = self.app.extensions['sms_fake_provider'] = sms_queue.FakeSmsProvider()
+
+    def test_send(self):
+        sms_queue.enqueue('13700000001-a', '13700000001', 'sign', 'SMS_1', {'code': '123456'})
+        self.assertTrue(sms_queue.work_once())
+        self.assertFalse(sms_queue.work_once())
+        self.assertEqual(self.fake.sent, [('13700000001-a', '13700000001', 'SMS_1', {'code': '123456'})])
+        self.assertEqual(sms_queue.stats()['sent'], 1)
+
+    def test_retry_then_dead_letter(self):
+        self.fake.fail_rate = 1
+        sms_queue.enqueue('13700000001-a', '13700000001', 'sign', 'SMS_1', {'code': '123456'})
+        self.assertTrue(sms_queue.work_once())
+        # 重试未到期
+        self.assertFalse(sms_queue.work_once())
+        self.assertEqual(sms_queue.stats()['delayed'], 1)
+        self.assertEqual(sms_queue.promote(now=time.time() + self.app.config['SMS_RETRY_BASE'] + 1), 1)
+        self.assertTrue(sms_queue.work_once())
+        stats = sms_queue.stats()
+        self.assertEqual((stats['queued'], stats['delayed'], stats['dead'], stats['retried']), (0, 0, 1, 1))
+        self.assertEqual(self.fake.sent, [])
+
+
+class QuotaLedgerTestCase(AppTestCase):
+    config = {'QUOTA_LEDGER': True}
+    redis_keys = [quota.DIRTY_KEY, quota.LEDGER_KEY % (1, 1)]
+
+    def add_member(self, **kwargs):
+        member = SchoolStudent(school_id=1, student_id=1, **kwargs)
+        db.session.add(member)
+        db.session.commit()
+        return member
+
+    def test_consume_and_flush(self):
+        member = self.add_member(
+            nomal_times=1,
+            vip_times=1,
+            vip_expire=datetime.utcnow() + timedelta(days=1)
+        )
+        self.assertEqual(quota.consume_ask(1, 1), quota.VIP_TIMES)
+        self.assertEqual(quota.consume_ask(1, 1), quota.NOMAL_TIMES)
+        self.assertEqual(quota.consume_ask(1, 1), quota.NO_QUOTA)
+        self.assertFalse(quota.can_ask(1, 1))
+        # 写回前数据库不变
+        db.session.refresh(member)
+        self.assertEqual(member.nomal_times, 1)
+        # 老师/管理员查看时读账本
+        self.assertEqual(quota.times(member), (0, 0))
+        self.assertEqual(quota.flush(), 1)
+        db.session.refresh(member)
+        self.assertEqual((member.vip_times, member.nomal_times), (0, 0))
+        self.assertEqual(quota.flush(), 0)
+
+    def test_consume_not_member(self):
+        self.assertEqual(quota.consume_ask(1, 1), quota.NO_QUOTA)
+
+    def test_reset_overwrites_ledger(self):
+        member = self.add_member(nomal_times=1)
+        self.assertEqual(quota.consume_ask(1, 1), quota.NOMAL_TIMES)
+        member.nomal_times = 5
+        db.session.commit()
+        # 老师提交之后、覆盖账本之前，一次 flush 把旧快照写回了数据库
+        SchoolStudent.query.filter_by(school_id=1, student_id=1).update({'nomal_times': 0})
+        db.session.commit()
+        quota.reset(1, 1, member.vip_times, 5, member.vip_expire)
+        self.assertEqual(quota.times(member), (member.vip_times, 5))
+        quota.flush()
+        db.session.refresh(member)
+        self.assertEqual(member.nomal_times, 5)
+
+    def test_flush_skips_reset_after_snapshot(self):
+        member = self.add_member(nomal_times=1)
+        self.assertEqual(quota.consume_ask(1, 1), quota.NOMAL_TIMES)
+        pipeline = redis_store.pipeline
+
+        # 快照读完后老师修改次数
+        def snapshot_then_reset(*args, **kwargs):
+            redis_store.pipeline = pipeline
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            def reset_after_read():
+                result = execute()
+                quota.reset(1, 1, member.vip_times, 5, member.vip_expire)
+                return result
+            pipe.execute = reset_after_read
+            return pipe
+        redis_store.pipeline = snapshot_then_reset
+        try:
+            quota.flush()
+        finally:
+            redis_store.pipeline = pipeline
+        db.session.refresh(member)
+        self.assertEqual(member.nomal_times, 1)
+        self.assertEqual(quota.flush(), 1)
+        db.session.refresh(member)
+        self.assertEqual(member.nomal_times, 5)
+
+
+class MembershipCacheTestCase(AppTestCase):
+    config = {'MEMBERSHIP_CACHE_TTL': 60}
+
+    def clear_redis(self):
+        membership.invalidate_school(1)
+
+    def test_employ_served_from_cache(self):
+        t = Teacher(telephone='13700000000')
+        s = School(name='aschool')
+        t.schools.append(s)
+        db.session.add_all([t, s])
+        db.session.commit()
+        self.assertTrue(t.is_employ(s.id))
+        # 绕过模型直接删除，缓存仍然认为是本校老师
+        db.session.execute(employs.delete())
+        db.session.commit()
+        self.assertTrue(t.is_employ(s.id))
+        membership.invalidate_teachers(s.id)
+        self.assertFalse(t.is_employ(s.id))
+
+    def test_dismiss_invalidates(self):
+        t = Teacher(telephone='13700000000')
+        s = School(name='aschool')
+        t.schools.append(s)
+        db.session.add_all([t, s])
+        db.session.commit()
+        self.assertTrue(t.is_employ(s.id))
+        t.dismiss_school(s.id)
+        self.assertFalse(t.is_employ(s.id))
+
+    def test_join_after_cached_negative(self):
+        st = Student(telephone='13700000000')
+        other = Student(telephone='13700000001')
+        sc = School(name='aschool')
+        sc.courses.append(Course())
+        db.session.add_all([st, other, sc])
+        db.session.commit()
+        other.join_school(sc.id)
+        self.assertTrue(other.is_school_joined(sc.id))
+        self.assertFalse(st.is_school_joined(sc.id))
+        st.join_school(sc.id)
+        self.assertTrue(st.is_school_joined(sc.id))
+        self.assertTrue(redis_store.sismember(membership.MEMBERS_KEY % (sc.id, membership.STUDENTS), st.id))
+
+
+class CapabilityTokenTestCase(AppTestCase):
+    redis_keys = [capabilities.VERSION_KEY % ('teacher', 1)]
+
+    def test_teacher_token_capabilities(self):
+        t = Teacher(telephone='13700000000')
+        admin_school = School(name='a', admin='13700000000')
+        other_school = School(name='b')
+        t.schools.append(admin_school)
+        t.schools.append(other_school)
+        db.session.add_all([t, admin_school, other_school])
+        db.session.commit()
+        token = t.generate_auth_token()
+        user = Teacher.verify_auth_token(token)
+        self.assertEqual(user.capabilities.schools, {admin_school.id, other_school.id})
+        self.assertEqual(user.capabilities.admin_schools, {admin_school.id})
+        # 绕过模型删除，token 中的权限仍然有效
+        db.session.execute(employs.delete().where(employs.c.school_id == other_school.id))
+        db.session.commit()
+        self.assertTrue(user.is_employ(other_school.id))
+        self.assertTrue(user.is_teacher_admin(admin_school.id))
+
+    def test_membership_change_revokes_capabilities(self):
+        t = Teacher(telephone='13700000000')
+        s = School(name='a')
+        t.schools.append(s)
+        db.session.add_all([t, s])
+        db.session.commit()
+        token = t.generate_auth_token()
+        t.dismiss_school(s.id)
+        user = Teacher.verify_auth_token(token)
+        self.assertIsNone(user.capabilities)
+        self.assertFalse(user.is_employ(s.id))
+        fresh = Teacher.verify_auth_token(user.generate_auth_token())
+        self.assertEqual(fresh.capabilities.schools, frozenset())